@@ -25,15 +25,47 @@ import getopt
 import os
 import math
 import re
+import time
+import array
+import collections
+import itertools
+
+#command line option specifications for getopt, also used by the query server (--serve) to find the input files of a query
+SHORTOPTIONS = "f:k:d:e:D:o:is:SH:TC:nNM:1x:y:A:Z:a:vVg:G:R"
+LONGOPTIONS = ["bar","plotgrid","plotxlog","plotylog","plotconf=","plotfile=","scatterplot","lineplot","plottitle","copysuffix=","nl","html","latex","profile","profilejson=","progress=","plotpoints=","merge","unique=","uniquemem=","uniquebloom=","uniquecapacity=","pipeline","blocksize=","follow","followinterval=","checkpoint=","rolling=","tumbling=","numpy","cooc=","cooctop=","serve","client","socket=","servememory="]
+
+#Heavy optional dependencies, these are only imported on first use (see loadnumpy(), loadplotting() and loadgtk()) to keep startup fast
+numpy = None
+matplotlib = None
+gtk = None
+
+def loadnumpy():
+    """Import numpy on demand"""
+    global numpy
+    if numpy is None:
+        import numpy
+
+def loadplotting(backend=None):
+    """Import numpy and matplotlib on demand (backend 'Agg' for plotting to file)"""
+    global matplotlib
+    loadnumpy()
+    if matplotlib is None or not 'matplotlib.pyplot' in sys.modules:
+        import matplotlib
+        if 'matplotlib.pyplot' in sys.modules:
+            #pyplot was already loaded by our caller (library use), respect its backend unless we need a specific one
+            if backend:
+                matplotlib.pyplot.switch_backend(backend)
+        else:
+            matplotlib.use(backend or 'GTKAgg')
+            import matplotlib.pyplot
+    elif backend and matplotlib.get_backend().lower() != backend.lower():
+        matplotlib.pyplot.switch_backend(backend)
 
-
-if '-x' in sys.argv[1:]: #don't import if not used, to save time
-    import numpy
-    import matplotlib
-    matplotlib.use('GTKAgg')
-    import matplotlib.pyplot
-if '-V' in sys.argv[1:]: #don't import if not used, to save time
-    import gtk
+def loadgtk():
+    """Import gtk on demand"""
+    global gtk
+    if gtk is None:
+        import gtk
 
 
 def usage():
@@ -64,12 +96,34 @@ def usage():
     print >>sys.stderr," -A [columns]     Sort by columns, in ascending order"
     print >>sys.stderr," -Z [columns]     Sort by columns, in descending order"
     print >>sys.stderr," -R               Reverse axes on output"
+    print >>sys.stderr," --unique=[columns]         Output only the first occurrence of each row, or of each combination of values in the specified columns (leave empty for all columns)"
+    print >>sys.stderr," --uniquemem=[MB]           Memory budget for --unique, beyond it hashes are spilled to disk partitions and all further output is held back until the end of the input (default: 512)"
+    print >>sys.stderr," --uniquebloom=[rate]       Approximate --unique using a Bloom filter with the specified false positive rate (e.g. 0.001), duplicates are always removed but some unique rows may be lost"
+    print >>sys.stderr," --uniquecapacity=[n]       Expected number of unique rows, used to size the Bloom filter (default: 10000000)"
+    print >>sys.stderr," --pipeline       Pipelined mode: read/decode, processing and output writing run in separate threads, passing blocks of lines"
+    print >>sys.stderr," --blocksize=[bytes]        Size of the blocks read in pipelined mode (default: 1048576)"
+    print >>sys.stderr," --follow         Follow mode: keep the (first) input file open and process lines as they are appended to it, until interrupted"
+    print >>sys.stderr," --followinterval=[seconds] Interval at which statistics and histograms are refreshed in follow mode (default: 60)"
+    print >>sys.stderr," --checkpoint=[filename]    Save the byte offset and statistics to this file in follow mode, and resume from it on restart"
+    print >>sys.stderr," --rolling=[function]:[column]:[size]      Add an output column with a rolling aggregate over the last size rows of the column. Functions: avg, sum, count, min, max. May be specified multiple times"
+    print >>sys.stderr," --tumbling=[function]:[column]:[keycolumn]:[width]   Output one summary row per tumbling window instead of the rows, windows span width units of the key column, which is numeric or an ISO 8601 timestamp (width in seconds, timestamps without timezone are taken as UTC). May be specified multiple times (with the same key column and width)"
+    print >>sys.stderr," --cooc=[col1],[col2]       Compute a co-occurrence (contingency) table of the values in two columns, with joint and marginal frequencies, conditional entropy H(col2|col1) and mutual information"
+    print >>sys.stderr," --cooctop=[k]              Keep only (about) the k most frequent pairs in the --cooc table to bound memory. Marginals stay exact, joint entropy and mutual information become approximations"
+    print >>sys.stderr," --numpy          Compute -S, -H and --cooc with the NumPy block engine, which processes blocks of lines at once. Only the statistics are outputted, not the rows. Can not be combined with options that select or transform rows"
+    print >>sys.stderr," --serve          Run as a query server on a local Unix socket. Input files are kept in memory (and reloaded when they change) and the output of repeated queries is cached. Queries use the normal options, sent with --client"
+    print >>sys.stderr," --client         Send the query (all other options and filenames) to a running query server instead of processing it here"
+    print >>sys.stderr," --socket=[path]            Socket of the query server (default: campyon-[uid].sock in the system temp directory)"
+    print >>sys.stderr," --servememory=[MB]         Memory budget of the query server for cached files and query results, least recently used ones are evicted first (default: 1024)"
+    print >>sys.stderr," --merge          Merge input files that are each already sorted on the columns given with -A/-Z, in a single streaming pass"
     print >>sys.stderr," -v               Pretty view output, replaces tabs with spaces to nicely align columns. You may want to combine this with -n and --nl, and perhaps -N"
     print >>sys.stderr," -V               Pretty view output in a GUI"
     print >>sys.stderr," --copysuffix=[suffix]       Output an output file with specified suffix for each inputfile (use instead of -o or -i)"
     print >>sys.stderr," --nl             Insert an extra empty newline after each line"
     print >>sys.stderr," --html           Output HTML table"
     print >>sys.stderr," --latex          Output LaTeX tabular"
+    print >>sys.stderr," --profile        Print a per-stage timing breakdown, throughput and peak memory usage on exit"
+    print >>sys.stderr," --profilejson=[filename]   Write the profiling report to the specified file as JSON (implies --profile)"
+    print >>sys.stderr," --progress=[seconds]       Report progress (bytes read, ETA) on stderr every so many seconds"
     print >>sys.stderr,"Selection shortcuts:"
     print >>sys.stderr," -g [key]         Does a grep. Shortcut for: -s 'A() == \"key\"'"
     print >>sys.stderr," -G [key]         Does an inverse grep. Shortcut for: -s 'not (A() == \"key\"')"
@@ -94,6 +148,7 @@ def usage():
     print >>sys.stderr," --plotxlog       X scale is logarithmic"
     print >>sys.stderr," --plotylog       Y scale is logarithmic"
     print >>sys.stderr," --plotfile=[filename]      Save plot to PNG file"
+    print >>sys.stderr," --plotpoints=[n]           Downsample each plotted series to at most n points (LTTB for line plots, random thinning for scatter plots)"
     print >>sys.stderr," --lineplot       Sets lineplot defaults"
     print >>sys.stderr," --scatterplot    Sets scatterplot defaults"
 
@@ -125,10 +180,135 @@ def calcentropy(d, base = 2):
       return entropy
 
 
+def peakmemory():
+    """Peak resident set size in kB, or None if unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def lttb(xs, ys, threshold):
+    """Downsample a line plot series with Largest-Triangle-Three-Buckets"""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return xs, ys
+
+    sampledxs = array.array('d', [xs[0]])
+    sampledys = array.array('d', [ys[0]])
+    every = (n - 2) / float(threshold - 2)
+    a = 0
+    for i in xrange(threshold - 2):
+        #average point of the next bucket
+        avgbegin = int((i + 1) * every) + 1
+        avgend = min(int((i + 2) * every) + 1, n)
+        avgx = avgy = 0.0
+        for j in xrange(avgbegin, avgend):
+            avgx += xs[j]
+            avgy += ys[j]
+        avgx /= (avgend - avgbegin)
+        avgy /= (avgend - avgbegin)
+
+        #select the point in this bucket that forms the largest triangle with the previously selected point and the next average
+        ax = xs[a]
+        ay = ys[a]
+        maxarea = -1
+        nexta = a
+        for j in xrange(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avgx) * (ys[j] - ay) - (ax - xs[j]) * (avgy - ay))
+            if area > maxarea:
+                maxarea = area
+                nexta = j
+        sampledxs.append(xs[nexta])
+        sampledys.append(ys[nexta])
+        a = nexta
+
+    sampledxs.append(xs[n-1])
+    sampledys.append(ys[n-1])
+    return sampledxs, sampledys
+
+def thin(xs, ys, threshold, seed=0):
+    """Downsample a scatter plot series by random thinning, keeping order"""
+    import random
+    n = len(xs)
+    if threshold >= n or threshold < 1:
+        return xs, ys
+    indices = sorted(random.Random(seed).sample(xrange(n), threshold))
+    return array.array('d', [ xs[i] for i in indices ]), array.array('d', [ ys[i] for i in indices ])
+
+
 class CampyonError(Exception):
     pass
 
+class CampyonProfiler(object):
+    """Per-stage timers and counters for --profile"""
+
+    STAGES = ('read','decode','split','select','hist','stats','convert','join','sort','reverseaxes','output','report')
+
+    def __init__(self):
+        self.timer = time.time
+        self.reset()
+
+    def reset(self):
+        self.times = {}
+        self.calls = {}
+        self.bytes = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.begintime = self.timer()
+
+    def lap(self, stage, t):
+        """Add the time since t to the stage, returns the current time"""
+        now = self.timer()
+        self.times[stage] = self.times.get(stage,0) + (now - t)
+        self.calls[stage] = self.calls.get(stage,0) + 1
+        return now
+
+    def data(self):
+        total = self.timer() - self.begintime
+        stages = {}
+        for stage in self.times:
+            stages[stage] = {'seconds': self.times[stage], 'calls': self.calls[stage], 'fraction': self.times[stage] / total if total else 0.0 }
+        return {
+            'total_seconds': total,
+            'stages': stages,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_per_sec': self.rows_in / total if total else 0.0,
+            'bytes': self.bytes,
+            'bytes_per_sec': self.bytes / total if total else 0.0,
+            'peak_rss_kb': peakmemory(),
+        }
+
+    def report(self, out=None):
+        if out is None: out = sys.stderr
+        data = self.data()
+        total = data['total_seconds']
+        out.write("STAGE\tSECONDS\tCALLS\tFRACTION\n")
+        stages = [ stage for stage in self.STAGES if stage in data['stages'] ] + sorted([ stage for stage in data['stages'] if not stage in self.STAGES ])
+        accounted = 0
+        for stage in stages:
+            d = data['stages'][stage]
+            accounted += d['seconds']
+            out.write(stage + "\t" + "%.4f" % d['seconds'] + "\t" + str(d['calls']) + "\t" + "%.1f%%" % (d['fraction'] * 100) + "\n")
+        out.write("other\t" + "%.4f" % (total - accounted) + "\t-\t" + "%.1f%%" % (((total - accounted) / total * 100) if total else 0.0) + "\n")
+        out.write("total\t" + "%.4f" % total + "\n")
+        out.write("Rows read: " + str(data['rows_in']) + ", outputted: " + str(data['rows_out']) + ", " + "%.1f" % data['rows_per_sec'] + " rows/sec\n")
+        out.write("Bytes read: " + str(data['bytes']) + ", " + "%.1f" % data['bytes_per_sec'] + " bytes/sec\n")
+        if data['peak_rss_kb'] is not None:
+            out.write("Peak memory: " + str(data['peak_rss_kb']) + " kB\n")
+
+    def writejson(self, filename):
+        import json
+        f = open(filename,'w')
+        json.dump(self.data(), f, indent=1)
+        f.close()
+
 class CampyonViewer(object):
+    """GTK viewer, fetches rows page by page through Campyon.viewport()"""
+
+    PAGESIZE = 1000
 
     # close the window and quit
     def delete_event(self, widget, event, data=None):
@@ -136,6 +316,15 @@ class CampyonViewer(object):
         return False
 
     def __init__(self, c, filename):
+        loadgtk()
+
+        self.c = c
+        self.filename = filename
+        if c.inmemory:
+            c.sortmemory()
+        self.total = c.viewportsize(filename)
+        self.loaded = 0
+
         # Create a new window
         self.window = gtk.Dialog() #gtk.WINDOW_TOPLEVEL)
 
@@ -152,9 +341,11 @@ class CampyonViewer(object):
         self.scrollwindow.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
         self.scrollwindow.show()
 
+        #infer the column types from the first page only
+        firstpage = c.viewport(0, self.PAGESIZE, filename)
         types = []
         first = True
-        for line, fields, linenum in c.processmemory():
+        for fields, linenum in firstpage:
             if first:
                 for field in fields:
                     if isinstance(field, float):
@@ -170,11 +361,9 @@ class CampyonViewer(object):
                         types[i] = float
                     elif isinstance(field, str) or isinstance(field, unicode):
                         types[i] = str
+        self.types = types
         if c.numberlines:
-            types.insert(0,int)
-
-
-        print repr(types)
+            types = [int] + types
 
         # create a liststore with one string column to use as the model
         self.liststore = gtk.ListStore(*types) #(str, str, str, 'gboolean')
@@ -189,23 +378,18 @@ class CampyonViewer(object):
                 self.columns.append( gtk.TreeViewColumn('#') )
                 self.cellrenderers.append( gtk.CellRendererText() )
 
-        if c.DOHEADER:
-            for colname in c.headerfields():
-                self.columns.append( gtk.TreeViewColumn(colname) )
-                self.cellrenderers.append( gtk.CellRendererText() )
+        if c.DOHEADER and not c.reverseaxes:
+            for i, colname in enumerate(c.headerfields()):
+                if (not c.keep or i+1 in c.keep) and not i+1 in c.delete:
+                    self.columns.append( gtk.TreeViewColumn(colname) )
+                    self.cellrenderers.append( gtk.CellRendererText() )
         else:
-            for num in range(1,len(types)+1):
+            for num in range(1,len(self.types)+1):
                 self.columns.append( gtk.TreeViewColumn(str(num)) )
                 self.cellrenderers.append( gtk.CellRendererText() )
 
         #add data
-        first = True
-        for line, fields, linenum in c.processmemory():
-            if c.numberlines:
-                fields = [linenum] + fields
-            if (c.DOHEADER and not first) or not c.DOHEADER:
-                self.liststore.append(fields)
-            first = False
+        self.append(firstpage)
 
         # add columns to treeview
         for col in self.columns:
@@ -251,6 +435,9 @@ class CampyonViewer(object):
 
         self.scrollwindow.add_with_viewport(self.treeview)
 
+        # fetch the next page when the user scrolls near the end of what is loaded
+        self.scrollwindow.get_vadjustment().connect("value-changed", self.scrolled)
+
         #self.window.add(self.treeview)
 
         self.window.vbox.pack_start(self.scrollwindow, True, True, 0)
@@ -258,6 +445,44 @@ class CampyonViewer(object):
         self.scrollwindow.show_all()
         self.window.show_all()
 
+    def fits(self, field, type):
+        """Does the field fit a column of the type inferred from the first page?"""
+        if type == str:
+            return True
+        elif type == float:
+            return isinstance(field, (int, long, float))
+        else:
+            return isinstance(field, (int, long))
+
+    def widen(self, columns):
+        """Show the specified columns as text from now on, rebuilds the liststore with the rows loaded so far"""
+        for i in columns:
+            self.types[i] = str
+        offset = 1 if self.c.numberlines else 0
+        liststore = gtk.ListStore(*([int] * offset + self.types))
+        for row in self.liststore:
+            values = list(row)
+            for i in columns:
+                values[i+offset] = unicode(values[i+offset])
+            liststore.append(values)
+        self.liststore = liststore
+        self.treeview.set_model(liststore)
+
+    def append(self, rows):
+        for fields, linenum in rows:
+            mismatches = [ i for i, (field, type) in enumerate(zip(fields, self.types)) if not self.fits(field, type) ]
+            if mismatches:
+                self.widen(mismatches)
+            fields = [ unicode(field) if type == str else field for field, type in zip(fields, self.types) ]
+            if self.c.numberlines:
+                fields = [linenum] + fields
+            self.liststore.append(fields)
+        self.loaded += len(rows)
+
+    def scrolled(self, adjustment):
+        if self.loaded < self.total and adjustment.get_value() + adjustment.get_page_size() >= adjustment.get_upper() - adjustment.get_page_size():
+            self.append(self.c.viewport(self.loaded, self.PAGESIZE, self.filename))
+
 
 class Campyon(object):
     def _parsekwargs(self, key, default, kwargs):
@@ -298,15 +523,21 @@ class Campyon(object):
         return l
 
     def __init__(self, *args, **kwargs):
-        try:
-	        opts, args = getopt.getopt(args, "f:k:d:e:D:o:is:SH:TC:nNM:1x:y:A:Z:a:vVg:G:R",["bar","plotgrid","plotxlog","plotylog","plotconf=","plotfile=","scatterplot","lineplot","plottitle","copysuffix=","nl","html","latex"])
-        except getopt.GetoptError, err:
-	        # print help information and exit:
-	        print str(err)
-	        usage()
-	        sys.exit(2)
+        if args:
+            try:
+                opts, args = getopt.getopt(args, SHORTOPTIONS, LONGOPTIONS)
+            except getopt.GetoptError, err:
+                # print help information and exit:
+                print str(err)
+                usage()
+                sys.exit(2)
+        else:
+            #library use with keyword arguments only, no need for option parsing
+            opts = []
 
         self.filenames = self._parsekwargs('filenames',"",kwargs)
+        if isinstance(self.filenames, str) or isinstance(self.filenames, unicode):
+            self.filenames = [self.filenames]
         self.encoding = self._parsekwargs('encoding',"utf-8",kwargs)
         self.delete = self._parsekwargs('delete',[],kwargs)
         self.keep = self._parsekwargs('keep',[],kwargs)
@@ -333,22 +564,47 @@ class Campyon(object):
         self.plotconf = self._parsekwargs('plotconf',['r.-','g.-','b.-','y.-','m.-','c.-'],kwargs)
         self.plotfile = self._parsekwargs('plotfile',"",kwargs)
         self.plottitle = self._parsekwargs('plottitle',"",kwargs)
+        self.plotpoints = self._parsekwargs('plotpoints',0,kwargs)
+
+        self.profile = self._parsekwargs('profile',False,kwargs)
+        self.profilejson = self._parsekwargs('profilejson',"",kwargs)
+        self.progressinterval = self._parsekwargs('progressinterval',0,kwargs)
+        self.merge = self._parsekwargs('merge',False,kwargs)
+        self.DOUNIQUE = self._parsekwargs('DOUNIQUE',False,kwargs)
+        self.unique = self._parsekwargs('unique',[],kwargs) #key columns, empty for all
+        self.uniquememory = self._parsekwargs('uniquememory',512,kwargs) #MB
+        self.uniquebloom = self._parsekwargs('uniquebloom',0,kwargs) #false positive rate, 0 for exact
+        self.uniquecapacity = self._parsekwargs('uniquecapacity',10000000,kwargs)
+        self.pipeline = self._parsekwargs('pipeline',False,kwargs)
+        self.blocksize = self._parsekwargs('blocksize',1024*1024,kwargs) #bytes
+        self.pipelinequeue = self._parsekwargs('pipelinequeue',8,kwargs) #maximum number of blocks in flight between two stages
+        self.follow = self._parsekwargs('follow',False,kwargs)
+        self.followinterval = self._parsekwargs('followinterval',60,kwargs) #seconds
+        self.pollinterval = self._parsekwargs('pollinterval',1.0,kwargs) #seconds
+        self.checkpoint = self._parsekwargs('checkpoint',"",kwargs)
+        self.rollingsettings = self._parsekwargs('rolling',[],kwargs) #list of function:column:size specifications
+        self.tumblingsettings = self._parsekwargs('tumbling',[],kwargs) #list of function:column:keycolumn:width specifications
+        self.numpyengine = self._parsekwargs('numpyengine',False,kwargs)
+        self.cooc = self._parsekwargs('cooc',[],kwargs) #two column indices
+        self.cooctop = self._parsekwargs('cooctop',0,kwargs) #number of pairs to keep, 0 for all
+        self.filecache = self._parsekwargs('filecache',None,kwargs) #ServerCache holding the lines of input files, used by the query server
 
         self.prettyview = False
         self.extranewline = False
         self.guiview = False
         self.html = False
         self.latex = False
+        self.outputstrings = True #set to False to skip building the output string of each row (process() then yields None instead)
 
 
 
         self.fieldcount = 0
         self.header =  {}
-        self.sortreverse = False
+        self.sortreverse = self._parsekwargs('sortreverse',False,kwargs)
         self.inmemory = False
-        self.xs = []
-        self.ys = {}
-        self.reverseaxes = False
+        self.xs = array.array('d') #becomes a list if the x column turns out not to be numeric
+        self.ys = {} #column => array.array('d')
+        self.reverseaxes = self._parsekwargs('reverseaxes',False,kwargs)
 
         self.keepsettings = ""
         self.deletesettings = ""
@@ -357,6 +613,18 @@ class Campyon(object):
         self.sortsettings = ""
         self.plotxsettings = ""
         self.plotysettings = ""
+        self.uniquesettings = ""
+        self.coocsettings = ""
+
+        #column specifications passed as keyword arguments in string form (e.g. keep="1,3:5" or keep="ID,NAME") are resolved by init() once the header is known
+        for setting in ('keep','delete','hist','highlight','sort','unique','cooc'):
+            value = getattr(self, setting)
+            if isinstance(value, str) or isinstance(value, unicode):
+                setattr(self, setting + 'settings', value)
+                setattr(self, setting, [])
+        if isinstance(self.x, str) or isinstance(self.x, unicode):
+            self.plotxsettings = self.x
+            self.x = None
 
         for o, a in opts:
             if o == "-e":
@@ -414,6 +682,8 @@ class Campyon(object):
                 self.plotconf = a.split(',')
             elif o == '--plotfile':
                 self.plotfile = a
+            elif o == '--plotpoints':
+                self.plotpoints = int(a)
             elif o == "--lineplot":
                 self.plotconf = self._parsekwargs('plotconf',['r-','g-','b-','y-','m-','c-'],kwargs)
             elif o == "--scatterplot":
@@ -429,6 +699,46 @@ class Campyon(object):
             elif o == '-R':
                 self.reverseaxes = True
                 self.inmemory = True
+            elif o == '--profile':
+                self.profile = True
+            elif o == '--profilejson':
+                self.profile = True
+                self.profilejson = a
+            elif o == '--progress':
+                self.progressinterval = float(a)
+            elif o == '--merge':
+                self.merge = True
+            elif o == '--unique':
+                self.DOUNIQUE = True
+                self.uniquesettings = a
+            elif o == '--uniquemem':
+                self.uniquememory = float(a)
+            elif o == '--uniquebloom':
+                self.uniquebloom = float(a)
+            elif o == '--uniquecapacity':
+                self.uniquecapacity = int(a)
+            elif o == '--pipeline':
+                self.pipeline = True
+            elif o == '--blocksize':
+                self.blocksize = int(a)
+            elif o == '--follow':
+                self.follow = True
+            elif o == '--followinterval':
+                self.followinterval = float(a)
+            elif o == '--checkpoint':
+                self.checkpoint = a
+            elif o == '--rolling':
+                self.rollingsettings.append(a)
+            elif o == '--tumbling':
+                self.tumblingsettings.append(a)
+            elif o == '--numpy':
+                self.numpyengine = True
+            elif o == '--cooc':
+                self.coocsettings = a
+            elif o == '--cooctop':
+                self.cooctop = int(a)
+            elif o in ('--serve','--client','--socket','--servememory'):
+                pass #handled by servermain()
             elif o == '-a':
                 raise NotImplementedError
             else:
@@ -447,7 +757,36 @@ class Campyon(object):
                 sys.exit(2)
 
 
-        if self.sort or self.sortsettings or self.prettyview or self.guiview:
+        if self.numpyengine:
+            if not self.DOSTATS and not self.hist and not self.histsettings and not self.cooc and not self.coocsettings:
+                print >>sys.stderr,"ERROR: --numpy requires -S, -H and/or --cooc"
+                sys.exit(2)
+            if self.select or self.DOUNIQUE or self.unique or self.rollingsettings or self.tumblingsettings or self.sort or self.sortsettings or self.prettyview or self.guiview or self.reverseaxes or self.overwriteinput or self.copysuffix or self.merge or self.follow or self.plotxsettings or self.x:
+                print >>sys.stderr,"ERROR: --numpy can not be combined with options that select, transform or output rows"
+                sys.exit(2)
+        elif self.follow:
+            if self.sort or self.sortsettings or self.prettyview or self.guiview or self.reverseaxes or self.overwriteinput or self.copysuffix or self.merge:
+                print >>sys.stderr,"ERROR: --follow can not be combined with -A, -Z, -v, -V, -R, -i, --copysuffix or --merge"
+                sys.exit(2)
+            if (self.DOUNIQUE or self.unique) and not self.uniquebloom:
+                #a spilled exact filter holds rows back until the end of the input, which never comes
+                print >>sys.stderr,"ERROR: --follow can only be combined with --unique when using --uniquebloom"
+                sys.exit(2)
+        elif self.merge:
+            if not self.sort and not self.sortsettings:
+                print >>sys.stderr,"ERROR: --merge requires the sort columns to be specified with -A or -Z"
+                sys.exit(2)
+            if self.prettyview or self.guiview or self.reverseaxes or self.overwriteinput or self.copysuffix:
+                print >>sys.stderr,"ERROR: --merge can not be combined with -v, -V, -R, -i or --copysuffix"
+                sys.exit(2)
+            if (self.DOUNIQUE or self.unique) and not self.uniquebloom:
+                #rows deferred by a spilled exact filter could only come out after the merge, unsorted
+                print >>sys.stderr,"ERROR: --merge can only be combined with --unique when using --uniquebloom"
+                sys.exit(2)
+        elif self.sort or self.sortsettings or self.prettyview or self.reverseaxes:
+            self.inmemory = True
+        elif self.guiview and (self.DOSTATS or self.hist or self.histsettings or self.cooc or self.coocsettings or self.x or self.plotxsettings or self.y or self.plotysettings or self.DOUNIQUE or self.unique or self.rollingsettings or self.tumblingsettings):
+            #statistics, plots and row transformations need a full pass through process(), the lazily paging viewer only applies selection
             self.inmemory = True
 
 
@@ -456,6 +795,9 @@ class Campyon(object):
         self.sumdata = {}
         self.nostats = set()
         self.freq = {}
+        self.cooctable = None
+        self.lineindex = {} #filename => (mtime, offsets, linenums), see buildindex()
+        self.uniquefilter = None
 
 
         if self.keep:
@@ -466,9 +808,17 @@ class Campyon(object):
         self.rowcount_in = 0
         self.rowcount_out = 0
 
+        if self.profile or self.profilejson:
+            self.profiler = CampyonProfiler()
+        else:
+            self.profiler = None
+
 
     def init(self, filename):
-        f = codecs.open(filename,'r',self.encoding)
+        if self.filecache:
+            f = iter(self.filecache.lines(filename, self.encoding))
+        else:
+            f = codecs.open(filename,'r',self.encoding)
         for line in f:
             if line.strip() and (not self.commentchar or line[:len(self.commentchar)] != self.commentchar):
                 if not self.delimiter:
@@ -496,7 +846,8 @@ class Campyon(object):
                     for col, name in self.header.items():
                         print >>sys.stderr,"Column #"+str(col)+":", name.encode('utf-8')
                 break
-        f.close()
+        if not self.filecache:
+            f.close()
 
 
         if self.keepsettings: self.keep = self.parsecolumns(self.keepsettings)
@@ -506,15 +857,123 @@ class Campyon(object):
         if self.sortsettings: self.sort = self.parsecolumns(self.sortsettings)
         if self.plotxsettings: self.x = self.parsecolumnindex(self.plotxsettings)
         if self.plotysettings: self.y = self.parsecolumns(self.plotysettings)
+        if self.uniquesettings: self.unique = self.parsecolumns(self.uniquesettings)
+        if self.coocsettings: self.cooc = self.parsecolumns(self.coocsettings)
+        if self.cooc and len(self.cooc) != 2:
+            raise CampyonError("Co-occurrence table requires exactly two columns, got: " + ",".join([ str(x) for x in self.cooc ]))
+        self.initwindows()
+
+    def initwindows(self):
+        """Set up the --rolling and --tumbling aggregates"""
+        self.rolling = [] #(column, RollingWindow)
+        for setting in self.rollingsettings:
+            try:
+                function, column, size = setting.split(':')
+                self.rolling.append( (self.parsecolumnindex(column), RollingWindow(function, int(size))) )
+            except ValueError:
+                raise CampyonError("Invalid rolling window specification: " + setting + ", expected function:column:size")
+
+        self.tumbling = [] #(column, TumblingWindow)
+        self.tumblingkey = None
+        self.tumblingwidth = None
+        self.tumblingwindow = None #index of the current window
+        self.tumblingcount = 0 #rows in the current window
+        self.tumblingtimestamps = False #key column holds ISO 8601 timestamps
+        self.tumblingskipped = 0 #rows without a valid key
+        self.tumblingrows = 0 #rows that went into a window
+        self.windowcount = 0
+        for setting in self.tumblingsettings:
+            try:
+                function, column, keycolumn, width = setting.split(':')
+                keycolumn = self.parsecolumnindex(keycolumn)
+                width = float(width)
+                self.tumbling.append( (self.parsecolumnindex(column), TumblingWindow(function)) )
+            except ValueError:
+                raise CampyonError("Invalid tumbling window specification: " + setting + ", expected function:column:keycolumn:width")
+            if self.tumblingkey is not None and (keycolumn != self.tumblingkey or width != self.tumblingwidth):
+                raise CampyonError("All tumbling windows must share the same key column and width")
+            self.tumblingkey = keycolumn
+            self.tumblingwidth = width
+
+    def windowheader(self, fields):
+        if self.tumbling:
+            return [u'window',u'count'] + [ window.function + u'(' + unicode(column) + u')' for column, window in self.tumbling ]
+        elif self.rolling:
+            return fields + [ window.function + u'(' + unicode(column) + u',' + unicode(window.size) + u')' for column, window in self.rolling ]
+        else:
+            return fields
+
+    def tumblingupdate(self, fields):
+        """Add a row to the tumbling window, returns the summary of the previous window if this row starts a new one"""
+        field = fields[self.tumblingkey-1]
+        key = numericvalue(field)
+        if key is None:
+            key = timestampvalue(field)
+            if key is None:
+                self.tumblingskipped += 1
+                self.rowcount_out -= 1
+                return None
+            self.tumblingtimestamps = True
+        windowindex = int(math.floor(key / self.tumblingwidth))
+        summary = None
+        if windowindex != self.tumblingwindow:
+            summary = self.tumblingflush()
+            self.tumblingwindow = windowindex
+        self.tumblingcount += 1
+        self.tumblingrows += 1
+        for column, window in self.tumbling:
+            window.update(numericvalue(fields[column-1]))
+        return summary
+
+    def tumblingflush(self):
+        """Summary row of the current tumbling window (or None), resets it"""
+        if self.tumblingwindow is None:
+            return None
+        start = self.tumblingwindow * self.tumblingwidth
+        if self.tumblingtimestamps:
+            start = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start))
+        elif start == int(start):
+            start = int(start)
+        summary = [start, self.tumblingcount] + [ window.value() for column, window in self.tumbling ]
+        summary = [ u'NA' if x is None else x for x in summary ]
+        for column, window in self.tumbling:
+            window.reset()
+        self.tumblingcount = 0
+        self.tumblingwindow = None
+        self.windowcount += 1
+        return summary
+
+    def newuniquefilter(self):
+        if not self.DOUNIQUE and not self.unique:
+            return None
+        elif self.uniquebloom:
+            return BloomFilter(self.uniquecapacity, self.uniquebloom)
+        else:
+            return UniqueFilter(int(self.uniquememory * 1024 * 1024))
 
-    def __call__(self):
+    def newcooctable(self):
+        if not self.cooc and not self.coocsettings:
+            return None
+        return CoocTable(self.cooctop)
+
+    def resetstate(self):
+        """Reset the rows, statistics, counters and unique filter for a new run"""
         self.memory = []
         self.sumdata = {}
         self.nostats = set()
         self.freq = {}
+        self.cooctable = self.newcooctable()
         self.rowcount_in = 0
         self.rowcount_out = 0
+        if self.uniquefilter:
+            self.uniquefilter.close()
+        self.uniquefilter = self.newuniquefilter()
+
+    def __call__(self):
+        self.resetstate()
         f_out = None
+        prof = self.profiler
+        if prof: prof.reset()
 
         if self.outputfile and not self.overwriteinput:
             f_out = codecs.open(self.outputfile, 'w',self.encoding)
@@ -522,7 +981,20 @@ class Campyon(object):
         if not self.overwriteinput and not self.copysuffix:
             self.init(self.filenames[0]) #initialise one, assume same column config for all!
 
-        for filename in self.filenames:
+        if self.merge:
+            self.writerows(self.processmerge(), f_out)
+        elif self.follow:
+            try:
+                self.writerows(self.processfollow(self.filenames[0], f_out), f_out)
+            except KeyboardInterrupt:
+                print >>sys.stderr, "Interrupted, stopping follow mode"
+            if self.checkpoint:
+                self.savecheckpoint(self.filenames[0])
+        elif self.numpyengine:
+            for filename in self.filenames:
+                self.processblocks(filename)
+
+        for filename in ([] if self.merge or self.follow or self.numpyengine else self.filenames):
 
             if self.overwriteinput or self.copysuffix:
                 self.memory = []
@@ -535,15 +1007,17 @@ class Campyon(object):
                 elif self.copysuffix:
                   f_out = codecs.open(filename + '.' + self.copysuffix, 'w',self.encoding)
 
-            for line, fields, linenum in self.process(filename):
-                if f_out:
-                    if self.numberlines: f_out.write(str(linenum) + self.delimiter)
-                    f_out.write(line + "\n")
-                else:
-                    if self.numberlines: print green(str(linenum)) + self.delimiter,
-                    print line.encode(self.encoding)
+            if self.guiview and not self.inmemory and not (self.overwriteinput or self.copysuffix):
+                #the viewer pages through the file itself, see viewport()
+                v = CampyonViewer(self, filename)
+                gtk.main()
+                del v
+                continue
+
+            self.writerows(self.process(filename), f_out)
 
             if self.overwriteinput or self.copysuffix:
+                if prof: t = prof.timer()
                 if self.prettyview:
                     margin = 2
                     colsize = {}
@@ -568,13 +1042,12 @@ class Campyon(object):
                     v = CampyonViewer(self, filename)
                     gtk.main()
                     del v
+                if prof and (self.prettyview or self.guiview): prof.lap('output', t)
 
 
             if f_out and (self.overwriteinput or self.copysuffix):
                 if self.inmemory and not self.prettyview and not self.guiview:
-                    for line, fields, linenum in self.processmemory():
-                        if self.numberlines: f_out.write(str(linenum) + self.delimiter)
-                        f_out.write(line + "\n")
+                    self.writerows(self.processmemory(), f_out)
                 f_out.close()
                 f_out = None
                 if self.overwriteinput:
@@ -582,6 +1055,7 @@ class Campyon(object):
 
         if self.inmemory and not self.overwriteinput and not self.copysuffix:
 
+            if prof: t = prof.timer()
             if self.prettyview:
                 margin = 2
                 colsize = {}
@@ -607,17 +1081,111 @@ class Campyon(object):
                 gtk.main()
                 del v
             else:
-                for line, fields, linenum in self.processmemory():
-                    if f_out:
-                        if self.numberlines: f_out.write(str(linenum) + self.delimiter)
-                        f_out.write(line + "\n")
-                    else:
-                        if self.numberlines: print green(str(linenum)) + self.delimiter,
-                        print line.encode(self.encoding)
+                self.writerows(self.processmemory(), f_out)
+            if prof and (self.prettyview or self.guiview): prof.lap('output', t)
 
         if f_out:
             f_out.close()
 
+        if prof: t = prof.timer()
+
+        self.printreport()
+
+        if prof: prof.lap('report', t)
+
+        if self.uniquefilter:
+            self.uniquefilter.close()
+
+        if self.x and self.y:
+            self.plot()
+
+        if prof:
+            self.printprofile()
+
+    def openinput(self, filename):
+        """Returns an iterable over the lines of an input file"""
+        if self.filecache:
+            return iter(self.filecache.lines(filename, self.encoding))
+        elif self.pipeline:
+            return PipelineReader(filename, self.encoding, self.blocksize, self.pipelinequeue)
+        elif self.profiler and u"\n".encode(self.encoding) == "\n":
+            #undecoded lines, so process() can time decoding separately from reading (ASCII compatible encodings only)
+            return open(filename,'rb')
+        else:
+            return codecs.open(filename,'r',self.encoding)
+
+    def pipelinewriter(self, rows, f_out=None):
+        """Pipelined writer: writes blocks of output in a separate thread"""
+        import threading
+        import Queue
+        queue = Queue.Queue(self.pipelinequeue)
+        errors = []
+
+        def write():
+            try:
+                while True:
+                    block = queue.get()
+                    if block is None:
+                        break
+                    if f_out:
+                        f_out.write(u"".join(block))
+                    else:
+                        sys.stdout.write("".join(block))
+            except Exception, e:
+                errors.append(e)
+                while queue.get() is not None: #keep draining so the producer never blocks
+                    pass
+
+        thread = threading.Thread(target=write, name="campyon-writer")
+        thread.daemon = True
+        thread.start()
+
+        prof = self.profiler
+        block = []
+        blocklines = max(self.blocksize // 256, 1)
+        for line, fields, linenum in rows:
+            if prof: t = prof.timer()
+            if f_out:
+                if self.numberlines:
+                    block.append(str(linenum) + self.delimiter + line + "\n")
+                else:
+                    block.append(line + "\n")
+            else:
+                if self.numberlines:
+                    prefix = green(str(linenum)) + self.delimiter.encode(self.encoding)
+                    if not prefix[-1].isspace() or prefix[-1] == ' ':
+                        prefix += " " #mimic the soft space of the print statement in the non-pipelined mode
+                    block.append(prefix + line.encode(self.encoding) + "\n")
+                else:
+                    block.append(line.encode(self.encoding) + "\n")
+            if len(block) >= blocklines:
+                queue.put(block)
+                block = []
+            if prof: prof.lap('output', t)
+        if block:
+            queue.put(block)
+        queue.put(None)
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def writerows(self, rows, f_out=None):
+        """Write (line, fields, linenum) rows to f_out or stdout"""
+        if self.pipeline:
+            return self.pipelinewriter(rows, f_out)
+        prof = self.profiler
+        for line, fields, linenum in rows:
+            if prof: t = prof.timer()
+            if f_out:
+                if self.numberlines: f_out.write(str(linenum) + self.delimiter)
+                f_out.write(line + "\n")
+            else:
+                if self.numberlines: print green(str(linenum)) + self.delimiter,
+                print line.encode(self.encoding)
+            if prof: prof.lap('output', t)
+
+    def printreport(self):
+        """Print statistics, histograms and the co-occurrence table"""
         if self.DOSTATS:
             self.printstats()
 
@@ -627,48 +1195,127 @@ class Campyon(object):
                 print >>sys.stderr,"------------------------------------------------------------------------"
                 self.printhist(fieldnum)
 
-        if self.x and self.y:
-            self.plot()
+        if self.cooctable:
+            self.printcooc()
+
+    def printprofile(self, out=None):
+        if out is None: out = sys.stderr
+        out.write("Profile:\n")
+        self.profiler.report(out)
+        if self.profilejson:
+            print >>sys.stderr, "Writing profile to " + self.profilejson
+            self.profiler.writejson(self.profilejson)
 
     def __iter__(self):
-        self.memory = []
-        self.sumdata = {}
-        self.nostats = set()
-        self.freq = {}
-        self.rowcount_in = 0
-        self.rowcount_out = 0
+        self.resetstate()
 
         self.init(self.filenames[0]) #initialise one, assume same column config for all!
 
+        if self.profiler: self.profiler.reset()
+
         for filename in self.filenames:
             for line, fields, linenum in self.process(filename):
                 yield line, fields, linenum
 
+        if self.uniquefilter:
+            self.uniquefilter.close()
+
+        if self.profiler:
+            self.printprofile()
+
+    def iter_batches(self, size=65536, lines=False, linenums=False):
+        """Iterate over the rows in column-oriented batches, yields (columns, linenums, lines)"""
+        self.resetstate()
+
+        self.init(self.filenames[0]) #initialise one, assume same column config for all!
+
+        outputstrings = self.outputstrings
+        self.outputstrings = lines
+        try:
+            rows = []
+            batchlinenums = []
+            batchlines = []
+            for filename in self.filenames:
+                headerfound = not self.DOHEADER or self.inmemory #the in-memory store holds no header
+                for line, fields, linenum in self.process(filename):
+                    if not fields:
+                        continue
+                    elif not headerfound:
+                        headerfound = True
+                        continue
+                    rows.append(fields)
+                    if linenums: batchlinenums.append(linenum)
+                    if lines: batchlines.append(line)
+                    if len(rows) >= size:
+                        yield self._batch(rows, batchlinenums if linenums else None, batchlines if lines else None)
+                        rows = []
+                        batchlinenums = []
+                        batchlines = []
+
+            if self.inmemory:
+                self.sortmemory()
+                for fields, linenum in self.memory:
+                    rows.append(fields)
+                    if linenums: batchlinenums.append(linenum)
+                    if lines: batchlines.append(self.delimiter.join([ unicode(x) for x in fields]))
+                    if len(rows) >= size:
+                        yield self._batch(rows, batchlinenums if linenums else None, batchlines if lines else None)
+                        rows = []
+                        batchlinenums = []
+                        batchlines = []
+
+            if rows:
+                yield self._batch(rows, batchlinenums if linenums else None, batchlines if lines else None)
+        finally:
+            self.outputstrings = outputstrings
+            if self.uniquefilter:
+                self.uniquefilter.close()
+
+    def _batch(self, rows, linenums, lines):
+        return [ list(column) for column in zip(*rows) ], linenums, lines
+
     def __len__(self):
+        return self.outputcount()
+
+    def outputcount(self):
+        """Number of rows outputted, in tumbling mode the windows take the place of the rows that went into them"""
+        if self.tumbling:
+            return self.rowcount_out - self.tumblingrows + self.windowcount
         return self.rowcount_out
 
 
 
-    def process(self, f):
+    def process(self, f, headerfound=False, summary=True):
         if self.overwriteinput:
             self.rowcount_in = 0
             self.rowcount_out = 0
 
-        if self.keep:
-            default = 'delete'
-        else:
-            default = 'keep'
-
-        headerfound = False
+        prof = self.profiler
+        if prof:
+            rowcount_in_begin = self.rowcount_in
+            rowcount_out_begin = self.outputcount()
 
         if isinstance(f, str) or isinstance(f, unicode):
-            f = codecs.open(f,'r',self.encoding)
+            f = self.openinput(f)
 
+        if prof or self.progressinterval:
+            f = self.monitor(f)
 
+        #rows go through processrow() only if profiling, --unique or windows need its per-row hooks
+        simple = not prof and not self.uniquefilter and not self.rolling and not self.tumbling
+        hist = self.hist
+        dostats = self.DOSTATS
+        cooc = self.cooc
+        cooctable = self.cooctable
+        delimiter = self.delimiter
+        inmemory = self.inmemory
 
+        t = None
         for line in f:
+            if prof: t = prof.timer()
             if not isinstance(line, unicode):
                 line = unicode(line, self.encoding)
+                if prof: t = prof.lap('decode', t)
             isheader = False
             self.rowcount_in += 1
 
@@ -685,6 +1332,7 @@ class Campyon(object):
             fields = line.strip().split(self.delimiter)
             if len(fields) != self.fieldcount:
                 raise CampyonError("Number of columns in line " + str(self.rowcount_in) + " deviates, expected " + str(self.fieldcount) + ", got " + str(len(fields)))
+            if prof: t = prof.lap('split', t)
 
             if self.DOHEADER and not headerfound:
                 headerfound = True
@@ -693,109 +1341,563 @@ class Campyon(object):
 
 
             if self.select and not isheader:
-                c = lambda x: fields[self.parsecolumnindex(x)-1].strip()
-                C = lambda x: ConjunctionSelector(c, *x)
-                D = lambda x: DisjunctionSelector(c, *x)
-                r = lambda x,y: re.search(x,c(y))
-                A = lambda: D(range(1,len(fields)+1))
-                if not eval(self.select):
+                if not self.selectrow(fields):
+                    if prof: prof.lap('select', t)
                     continue
+                if prof: t = prof.lap('select', t)
 
-            self.rowcount_out += 1
-
-
-            if self.hist and not isheader:
-                for fieldnum in self.hist:
-                    if not fieldnum in self.freq:
-                        self.freq[fieldnum] = {}
-                    if not fields[fieldnum-1] in self.freq[fieldnum]:
-                        self.freq[fieldnum][fields[fieldnum-1]] = 0
-                    self.freq[fieldnum][fields[fieldnum-1]] += 1
-
-            if self.DOSTATS and not isheader:
-                for i,field in enumerate(fields):
-                    fieldnum = i+1
-                    if not fieldnum in self.nostats:
-                        if '.' in field:
-                            try:
-                               x = float(field)
-                            except:
-                               self.nostats.add(fieldnum)
-                               if fieldnum in self.sumdata: del self.sumdata[fieldnum]
-                               continue
-                        else:
-                            try:
-                               x = int(field)
-                            except:
-                               self.nostats.add(fieldnum)
-                               if fieldnum in self.sumdata: del self.sumdata[fieldnum]
-                               continue
-
-                        if not fieldnum in self.sumdata:
-                            self.sumdata[fieldnum] = 0
-                        self.sumdata[fieldnum] += x
-
-
-
-            newfields = []
-            #k = [ x - 1 if x >= 0 else len(fields) + x for x in keep ]
-            #d = [ x - 1 if x >= 0 else len(fields) + x for x in delete ]
-            for i, field in enumerate(fields):
-                fieldnum = i+1
-                action = default
-                if fieldnum in self.keep:
-                    action = 'keep'
-                elif fieldnum in self.delete:
-                    action = 'delete'
-                if fieldnum in self.highlight and not self.guiview:
-                    field = bold(red(field))
-                if self.numberfields:
-                    if self.guiview:
-                        field = str(fieldnum) + '=' + field
-                    else:
-                        field = magenta(str(fieldnum)) + '=' + field
+            if simple:
+                #inline equivalent of processrow() and outputrow()
+                self.rowcount_out += 1
+                if not isheader:
+                    if hist: self.updatehist(fields)
+                    if cooctable: cooctable.update(fields[cooc[0]-1], fields[cooc[1]-1])
+                    if dostats: self.updatestats(fields)
+                newfields = self.convertfields(fields, isheader)
+                if self.outputstrings:
+                    s = delimiter.join([ unicode(x) for x in newfields ])
                 else:
-                    if field.isdigit() or field[0] == '-' and field[1:].isdigit():
-                        try:
-                            field = int(field)
-                        except:
-                            pass
-                    else:
-                        isfloat = True
-                        try:
-                            f = float(field)
-                        except:
-                            isfloat = False
-                        if isfloat:
-                            field = f
+                    s = None
+                if inmemory:
+                    if not isheader or self.reverseaxes:
+                        self.memory.append( (newfields, self.rowcount_out) )
+                else:
+                    yield s, newfields, self.rowcount_out
+                continue
 
-                if self.x == fieldnum and not isheader:
-                    self.xs.append(field)
+            if self.uniquefilter and not isheader:
+                new = self.uniquefilter.check([ fields[i-1] for i in self.unique ] if self.unique else fields, line.strip())
+                if prof: t = prof.lap('unique', t)
+                if not new:
+                    continue #duplicate, or deferred until the end (new is None)
 
-                if fieldnum in self.y and not isheader:
-                    if not isinstance(field, float) and not isinstance(field,int):
-                        raise CampyonError("Can not plot non-numeric values: " + field)
+            row = self.processrow(fields, isheader, t)
+            if row: yield row
 
-                    if not fieldnum in self.ys:
-                        self.ys[fieldnum] = []
-                    self.ys[fieldnum].append(field)
+        if self.uniquefilter:
+            #rows deferred by the unique filter after it exceeded its memory budget, in their original order
+            for line in self.uniquefilter.flush():
+                row = self.processrow(line.split(self.delimiter))
+                if row: yield row
 
-                if action == 'keep':
-                    newfields.append(field)
+        if self.tumbling:
+            #summary of the last window
+            summary = self.tumblingflush()
+            if summary:
+                row = self.outputrow(summary, self.windowcount)
+                if row: yield row
+            if self.tumblingskipped:
+                print >>sys.stderr, "WARNING: Skipped " + str(self.tumblingskipped) + " rows whose key (column #" + str(self.tumblingkey) + ") is neither numeric nor an ISO 8601 timestamp"
 
-            s = self.delimiter.join([ unicode(x) for x in newfields ])
-            if self.inmemory:
-                if not isheader or self.reverseaxes:
-                    self.memory.append( (newfields, self.rowcount_out) )
+        if prof and summary: #otherwise the caller (processmerge) does the accounting
+            prof.rows_in += self.rowcount_in - rowcount_in_begin
+            prof.rows_out += self.outputcount() - rowcount_out_begin
+
+        if summary:
+            print >>sys.stderr,"Read " + str(self.rowcount_in) + " lines, outputted " + str(self.outputcount())
+
+    def processrow(self, fields, isheader=False, t=None):
+        """Process a selected row, returns a (line, fields, linenum) tuple unless in memory mode"""
+        prof = self.profiler
+        if prof and t is None: t = prof.timer()
+
+        self.rowcount_out += 1
+
+
+        if self.hist and not isheader:
+            self.updatehist(fields)
+            if prof: t = prof.lap('hist', t)
+
+        if self.cooc and not isheader:
+            self.cooctable.update(fields[self.cooc[0]-1], fields[self.cooc[1]-1])
+            if prof: t = prof.lap('cooc', t)
+
+        if self.DOSTATS and not isheader:
+            self.updatestats(fields)
+            if prof: t = prof.lap('stats', t)
+
+
+
+        newfields = self.convertfields(fields, isheader)
+        if prof: t = prof.lap('convert', t)
+
+        linenum = self.rowcount_out
+        if self.rolling or self.tumbling:
+            if isheader:
+                newfields = self.windowheader(newfields)
+            elif self.tumbling:
+                newfields = self.tumblingupdate(fields)
+                if newfields is None:
+                    if prof: prof.lap('windows', t)
+                    return None
+                linenum = self.windowcount
             else:
-                yield s, newfields, self.rowcount_out
+                for column, window in self.rolling:
+                    x = window.update(numericvalue(fields[column-1]))
+                    newfields.append(u'NA' if x is None else x)
+            if prof: t = prof.lap('windows', t)
+
+        return self.outputrow(newfields, linenum, isheader, t)
+
+    def updatehist(self, fields):
+        freq = self.freq
+        for fieldnum in self.hist:
+            if not fieldnum in freq:
+                freq[fieldnum] = {}
+            columnfreq = freq[fieldnum]
+            field = fields[fieldnum-1]
+            if field in columnfreq:
+                columnfreq[field] += 1
+            else:
+                columnfreq[field] = 1
+
+    def updatestats(self, fields):
+        sumdata = self.sumdata
+        nostats = self.nostats
+        for i,field in enumerate(fields):
+            fieldnum = i+1
+            if not fieldnum in nostats:
+                try:
+                    if '.' in field:
+                        x = float(field)
+                    else:
+                        x = int(field)
+                except:
+                    nostats.add(fieldnum)
+                    if fieldnum in sumdata: del sumdata[fieldnum]
+                    continue
+                sumdata[fieldnum] = sumdata.get(fieldnum, 0) + x
+
+    def outputrow(self, newfields, linenum, isheader=False, t=None):
+        prof = self.profiler
+        if self.outputstrings:
+            s = self.delimiter.join([ unicode(x) for x in newfields ])
+            if prof: t = prof.lap('join', t)
+        else:
+            s = None
+        if self.inmemory:
+            if not isheader or self.reverseaxes:
+                self.memory.append( (newfields, linenum) )
+        else:
+            return s, newfields, linenum
+
+    def processblocks(self, filename):
+        """Compute -S, -H and --cooc a block of lines at a time with numpy (--numpy)"""
+        loadnumpy()
+        prof = self.profiler
+        t = None
+        if prof:
+            prof.bytes += os.path.getsize(filename)
+            rowcount_in_begin = self.rowcount_in
+            rowcount_out_begin = self.rowcount_out
+        headerfound = False
+        blocks = self.readblocks(filename)
+        while True:
+            if prof: t = prof.timer()
+            block = next(blocks, None)
+            if block is None:
+                break
+            if prof: t = prof.lap('read', t)
+
+            rows = []
+            for line in block:
+                if not isinstance(line, unicode):
+                    line = unicode(line, self.encoding)
+                self.rowcount_in += 1
+                self.rowcount_out += 1
+                if not line.strip() or (self.commentchar and line[:len(self.commentchar)] == self.commentchar):
+                    continue
+                fields = line.strip().split(self.delimiter)
+                if len(fields) != self.fieldcount:
+                    blocks.close()
+                    raise CampyonError("Number of columns in line " + str(self.rowcount_in) + " deviates, expected " + str(self.fieldcount) + ", got " + str(len(fields)))
+                if self.DOHEADER and not headerfound:
+                    headerfound = True
+                    continue
+                rows.append(fields)
+            if not rows:
+                continue
+            columns = zip(*rows)
+            if prof: t = prof.lap('split', t)
+
+            for fieldnum in self.hist:
+                self.histblock(fieldnum, columns[fieldnum-1])
+            if self.hist and prof: t = prof.lap('hist', t)
+
+            if self.cooc:
+                update = self.cooctable.update
+                for x, y in itertools.izip(columns[self.cooc[0]-1], columns[self.cooc[1]-1]):
+                    update(x, y)
+                if prof: t = prof.lap('cooc', t)
 
+            if self.DOSTATS:
+                for i, column in enumerate(columns):
+                    if not i+1 in self.nostats:
+                        self.statsblock(i+1, column)
+                if prof: t = prof.lap('stats', t)
+
+        if prof:
+            prof.rows_in += self.rowcount_in - rowcount_in_begin
+            prof.rows_out += self.rowcount_out - rowcount_out_begin
 
         print >>sys.stderr,"Read " + str(self.rowcount_in) + " lines, outputted " + str(self.rowcount_out)
 
+    def readblocks(self, filename):
+        """Blocks of about blocksize bytes of lines, for processblocks()"""
+        if self.filecache:
+            lines = self.filecache.lines(filename, self.encoding)
+            size = os.path.getsize(filename)
+            step = max(1, int(len(lines) * self.blocksize / float(size))) if size else 1
+            for i in xrange(0, len(lines), step):
+                yield lines[i:i+step]
+        else:
+            f = open(filename,'rb')
+            while True:
+                block = f.readlines(self.blocksize)
+                if not block:
+                    break
+                yield block
+            f.close()
+
+    def histblock(self, fieldnum, column):
+        """Histogram update for a block, new values in order of first occurrence"""
+        values, firstindices, counts = numpy.unique(numpy.array(column), return_index=True, return_counts=True)
+        values = values.tolist()
+        counts = counts.tolist()
+        if not fieldnum in self.freq:
+            self.freq[fieldnum] = {}
+        freq = self.freq[fieldnum]
+        for i in numpy.argsort(firstindices, kind='mergesort').tolist():
+            freq[values[i]] = freq.get(values[i], 0) + counts[i]
+
+    def statsblock(self, fieldnum, column):
+        """Sum update for a block, exactly as process() would sum it"""
+        dots = numpy.char.find(numpy.array(column), u'.') >= 0
+        total = self.sumdata.get(fieldnum, 0)
+        try:
+            if not dots.any():
+                try:
+                    values = numpy.fromiter(itertools.imap(int, column), dtype=numpy.int64, count=len(column))
+                except OverflowError:
+                    values = None #integers too large for int64, sum them as python integers below
+                if values is None:
+                    for field in column:
+                        total += int(field)
+                elif isinstance(total, float):
+                    #sequential float accumulation, as in process()
+                    total = float(numpy.add.accumulate(numpy.concatenate(([total], values.astype(numpy.float64))))[-1])
+                elif max(-int(values.min()), int(values.max())) >= (2**63 - 1) // len(values):
+                    total += sum(values.tolist()) #the sum might overflow int64, use python integers
+                else:
+                    total += int(numpy.add.reduce(values))
+            elif dots.all():
+                values = numpy.fromiter(itertools.imap(float, column), dtype=numpy.float64, count=len(column))
+                #np.add.accumulate adds strictly left to right, so the rounding matches a sequential python sum
+                total = float(numpy.add.accumulate(numpy.concatenate(([float(total)], values)))[-1])
+            else:
+                #mixed integers and floats in this block, fall back to per-field conversion
+                for field in column:
+                    if '.' in field:
+                        total += float(field)
+                    else:
+                        total += int(field)
+        except ValueError:
+            self.nostats.add(fieldnum)
+            if fieldnum in self.sumdata: del self.sumdata[fieldnum]
+            return
+        self.sumdata[fieldnum] = total
+
+    def selectrow(self, fields):
+        c = lambda x: fields[self.parsecolumnindex(x)-1].strip()
+        C = lambda x: ConjunctionSelector(c, *x)
+        D = lambda x: DisjunctionSelector(c, *x)
+        r = lambda x,y: re.search(x,c(y))
+        A = lambda: D(range(1,len(fields)+1))
+        return eval(self.select)
+
+    def convertfields(self, fields, isheader=False, collect=True):
+        """Convert and project the fields of a row, collecting plot data if requested"""
+        keep = self.keep
+        delete = self.delete
+        highlight = self.highlight
+        numberfields = self.numberfields
+        collect = collect and not isheader and (self.x or self.y)
+        if keep:
+            default = 'delete'
+        else:
+            default = 'keep'
+
+        newfields = []
+        #k = [ x - 1 if x >= 0 else len(fields) + x for x in keep ]
+        #d = [ x - 1 if x >= 0 else len(fields) + x for x in delete ]
+        for i, field in enumerate(fields):
+            fieldnum = i+1
+            action = default
+            if fieldnum in keep:
+                action = 'keep'
+            elif fieldnum in delete:
+                action = 'delete'
+            if highlight and fieldnum in highlight and not self.guiview:
+                field = bold(red(field))
+            if numberfields:
+                if self.guiview:
+                    field = str(fieldnum) + '=' + field
+                else:
+                    field = magenta(str(fieldnum)) + '=' + field
+            else:
+                if field.isdigit() or field[0] == '-' and field[1:].isdigit():
+                    try:
+                        field = int(field)
+                    except:
+                        pass
+                else:
+                    isfloat = True
+                    try:
+                        f = float(field)
+                    except:
+                        isfloat = False
+                    if isfloat:
+                        field = f
+
+            if collect and self.x == fieldnum:
+                if isinstance(self.xs, array.array) and not isinstance(field, float) and not isinstance(field, int):
+                    self.xs = list(self.xs)
+                self.xs.append(field)
+
+            if collect and fieldnum in self.y:
+                if not isinstance(field, float) and not isinstance(field,int):
+                    raise CampyonError("Can not plot non-numeric values: " + field)
+
+                if not fieldnum in self.ys:
+                    self.ys[fieldnum] = array.array('d')
+                self.ys[fieldnum].append(field)
+
+            if action == 'keep':
+                newfields.append(field)
+
+        return newfields
+
+    def monitor(self, f):
+        """Time reading (--profile) and report progress (--progress) while iterating over f"""
+        prof = self.profiler
+        stream = getattr(f, 'stream', f) #codecs readers wrap the actual file
+        try:
+            size = os.fstat(stream.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            size = None
+        if prof and size:
+            prof.bytes += size
+        interval = self.progressinterval
+        begintime = lastreport = time.time()
+        it = iter(f)
+        count = 0
+        while True:
+            if prof: t = prof.timer()
+            try:
+                line = next(it)
+            except StopIteration:
+                if prof: prof.lap('read', t)
+                break
+            if prof: prof.lap('read', t)
+            count += 1
+            if interval and count % 1000 == 0:
+                now = time.time()
+                if now - lastreport >= interval:
+                    lastreport = now
+                    self.printprogress(stream, size, count, now - begintime)
+            yield line
+
+    def printprogress(self, stream, size, count, elapsed):
+        try:
+            pos = stream.tell()
+        except (AttributeError, IOError, ValueError):
+            pos = None
+        if pos is not None and size:
+            if pos > 0:
+                eta = elapsed * (size - pos) / float(pos)
+            else:
+                eta = 0
+            print >>sys.stderr, "Progress: " + str(pos) + "/" + str(size) + " bytes (" + "%.1f" % (pos * 100.0 / size) + "%), " + str(count) + " lines, " + "%.0f" % (count / elapsed) + " lines/sec, ETA " + "%.0f" % eta + "s"
+        else:
+            print >>sys.stderr, "Progress: " + str(count) + " lines, " + "%.0f" % (count / elapsed) + " lines/sec"
+
+    def processfollow(self, filename, f_out=None):
+        """Process the file and keep following it as it grows (--follow)"""
+        import signal
+        offset = 0
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            offset = self.loadcheckpoint(filename)
+
+        #make termination by a service manager behave like an interrupt, so a final checkpoint gets written
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        while True:
+            for row in self.process(self.followlines(filename, offset, f_out), offset > 0):
+                yield row
+            #followlines() only stops when the file was truncated: start over, with the header and fresh statistics
+            offset = 0
+            self.resetstate()
+            self.initwindows()
+
+    def followlines(self, filename, offset=0, f_out=None):
+        """Yields lines appended to the file from offset onwards, until it is truncated"""
+        f = open(filename,'rb')
+        f.seek(offset)
+        self.followoffset = offset
+        buffer = ""
+        lastrefresh = time.time()
+        count = 0
+        while True:
+            chunk = f.readline()
+            if chunk:
+                buffer += chunk
+                if buffer[-1] == "\n":
+                    line = buffer
+                    buffer = ""
+                    yield unicode(line, self.encoding)
+                    #the consumer asked for the next line, so the previous one has been processed
+                    self.followoffset += len(line)
+                    count += 1
+                    if count % 1000 == 0 and time.time() - lastrefresh >= self.followinterval:
+                        self.followrefresh(filename, f_out)
+                        lastrefresh = time.time()
+                #else: incomplete line, it is still being written, wait for the rest
+            else:
+                #end of file reached for now
+                if time.time() - lastrefresh >= self.followinterval:
+                    self.followrefresh(filename, f_out)
+                    lastrefresh = time.time()
+                else:
+                    sys.stdout.flush()
+                    if f_out: f_out.flush()
+                if os.path.getsize(filename) < self.followoffset + len(buffer):
+                    print >>sys.stderr, "WARNING: " + filename + " was truncated, starting from the beginning"
+                    f.close()
+                    self.followoffset = 0
+                    return
+                else:
+                    time.sleep(self.pollinterval)
+                    f.seek(self.followoffset + len(buffer)) #clears the EOF state so new data can be read
+
+    def followrefresh(self, filename, f_out=None):
+        sys.stdout.flush()
+        if f_out: f_out.flush()
+        print >>sys.stderr, "=== " + time.strftime('%Y-%m-%d %H:%M:%S') + " - " + filename + " - read " + str(self.rowcount_in) + " lines, outputted " + str(self.outputcount()) + " ==="
+        self.printreport()
+        if self.checkpoint:
+            self.savecheckpoint(filename)
+
+    def savecheckpoint(self, filename):
+        import json
+        data = {
+            'filename': os.path.abspath(filename),
+            'offset': self.followoffset,
+            'rowcount_in': self.rowcount_in,
+            'rowcount_out': self.rowcount_out,
+            'tumblingrows': self.tumblingrows,
+            'windowcount': self.windowcount,
+            'sumdata': self.sumdata,
+            'nostats': list(self.nostats),
+            'freq': self.freq,
+            'cooc': self.cooctable.state() if self.cooctable else None,
+        }
+        f = open(self.checkpoint + '.tmp','w')
+        json.dump(data, f)
+        f.close()
+        os.rename(self.checkpoint + '.tmp', self.checkpoint)
+
+    def loadcheckpoint(self, filename):
+        """Restore the follow state from the checkpoint, returns the offset to resume from"""
+        import json
+        f = open(self.checkpoint)
+        data = json.load(f)
+        f.close()
+        if data['filename'] != os.path.abspath(filename):
+            print >>sys.stderr, "WARNING: Checkpoint " + self.checkpoint + " belongs to another file (" + data['filename'] + "), ignoring it"
+            return 0
+        elif os.path.getsize(filename) < data['offset']:
+            print >>sys.stderr, "WARNING: " + filename + " is smaller than at the checkpoint, it was probably truncated, starting from the beginning"
+            return 0
+        self.rowcount_in = data['rowcount_in']
+        self.rowcount_out = data['rowcount_out']
+        self.tumblingrows = data.get('tumblingrows', 0)
+        self.windowcount = data.get('windowcount', 0)
+        #json has string keys only, column indices are integers
+        self.sumdata = dict([ (int(k), v) for k, v in data['sumdata'].items() ])
+        self.nostats = set(data['nostats'])
+        self.freq = dict([ (int(k), v) for k, v in data['freq'].items() ])
+        if self.cooctable and data.get('cooc'):
+            self.cooctable.restore(data['cooc'])
+        print >>sys.stderr, "Resuming " + filename + " from checkpoint at byte offset " + str(data['offset'])
+        return data['offset']
+
+    def processmerge(self):
+        """Merge input files that are already sorted on the sort columns (--merge)"""
+        import heapq
+        self.mergeviolations = 0
+        rowcount_in_begin = self.rowcount_in
+        streams = [ self.mergestream(i, filename) for i, filename in enumerate(self.filenames) ]
+
+        #the streams read ahead of each other, so number the merged output here
+        linenum = 0
+        if self.DOHEADER:
+            fields = self.convertfields(self.headerfields(), True, False)
+            linenum += 1
+            yield self.delimiter.join([ unicode(x) for x in fields ]), fields, linenum
+
+        for key, i, seq, line, fields, _ in heapq.merge(*streams):
+            linenum += 1
+            yield line, fields, linenum
+
+        if self.profiler:
+            self.profiler.rows_in += self.rowcount_in - rowcount_in_begin
+            self.profiler.rows_out += linenum
+
+        print >>sys.stderr,"Read " + str(self.rowcount_in) + " lines, outputted " + str(self.outputcount())
+
+        if self.mergeviolations:
+            print >>sys.stderr, "WARNING: Input was not properly sorted, " + str(self.mergeviolations) + " sort order violation(s) found, output is not entirely sorted"
+
+    def mergestream(self, index, filename):
+        headerfound = not self.DOHEADER
+        prevkey = None
+        seq = 0
+        for line, fields, linenum in self.process(filename, summary=False):
+            if not fields:
+                continue #empty lines and comments have no place in a merged result
+            elif not headerfound:
+                headerfound = True
+                continue
+            seq += 1
+            key = tuple([ fields[i-1] for i in self.sort ])
+            if prevkey is not None and ((not self.sortreverse and key < prevkey) or (self.sortreverse and key > prevkey)):
+                self.mergeviolations += 1
+                if self.mergeviolations <= 10:
+                    print >>sys.stderr, "WARNING: " + filename + " is not sorted, row " + str(seq) + " (" + repr(key) + ") should come before the previous row (" + repr(prevkey) + ")"
+            prevkey = key
+            if self.sortreverse:
+                yield ReverseSortKey(key), index, seq, line, fields, linenum
+            else:
+                yield key, index, seq, line, fields, linenum
+
     def processmemory(self):
+        self.sortmemory()
+
+        if self.header:
+            fields = self.windowheader(self.headerfields())
+            s = self.delimiter.join( fields )
+            yield s, fields, 0
+
+        for fields, linenum in self.memory:
+            s = self.delimiter.join([ unicode(x) for x in fields])
+            yield s, fields, linenum
+
+    def sortmemory(self):
+        prof = self.profiler
+        if prof: t = prof.timer()
         if self.sort:
            self.memory = sorted(self.memory, key=lambda x: tuple([ x[0][i-1] for i in self.sort ]), reverse=self.sortreverse)
+           if prof: prof.lap('sort', t)
         elif self.reverseaxes:
             try:
                 tmp = []
@@ -808,14 +1910,68 @@ class Campyon(object):
                 self.header = False
             except KeyError:
                 raise CampyonError("Unable to reverse axes, dimensions not square")
+            if prof: prof.lap('reverseaxes', t)
 
-        if self.header:
-            s = self.delimiter.join( self.headerfields()  )
-            yield s, self.headerfields(), 0
+    def buildindex(self, filename):
+        """Byte offsets and line numbers of the selected rows of a file, cached"""
+        mtime = os.path.getmtime(filename)
+        if filename in self.lineindex and self.lineindex[filename][0] == mtime:
+            return self.lineindex[filename]
 
-        for fields, linenum in self.memory:
-            s = self.delimiter.join([ unicode(x) for x in fields])
-            yield s, fields, linenum
+        offsets = array.array('L')
+        linenums = array.array('L')
+        headerfound = False
+        offset = 0
+        linenum_in = 0
+        linenum = 0 #numbered like process() does: empty lines, comments and the header count as well
+        f = open(filename,'rb')
+        for rawline in f:
+            linenum_in += 1
+            line = unicode(rawline, self.encoding).strip()
+            if line and (not self.commentchar or line[:len(self.commentchar)] != self.commentchar):
+                fields = line.split(self.delimiter)
+                if len(fields) != self.fieldcount:
+                    f.close()
+                    raise CampyonError("Number of columns in line " + str(linenum_in) + " deviates, expected " + str(self.fieldcount) + ", got " + str(len(fields)))
+                if self.DOHEADER and not headerfound:
+                    headerfound = True
+                    linenum += 1
+                elif not self.select or self.selectrow(fields):
+                    linenum += 1
+                    offsets.append(offset)
+                    linenums.append(linenum)
+            else:
+                linenum += 1
+            offset += len(rawline)
+        f.close()
+
+        self.lineindex[filename] = (mtime, offsets, linenums)
+        return self.lineindex[filename]
+
+    def viewportsize(self, filename=None):
+        if self.inmemory:
+            return len(self.memory)
+        else:
+            if filename is None: filename = self.filenames[0]
+            return len(self.buildindex(filename)[1])
+
+    def viewport(self, offset, count, filename=None):
+        """Returns up to count (fields, linenum) rows starting at row offset"""
+        if offset < 0: offset = 0
+        if self.inmemory:
+            return self.memory[offset:offset+count]
+
+        if filename is None: filename = self.filenames[0]
+        _, offsets, linenums = self.buildindex(filename)
+        rows = []
+        f = open(filename,'rb')
+        for i in range(offset, min(offset+count, len(offsets))):
+            if i == offset or offsets[i] != f.tell():
+                f.seek(offsets[i])
+            fields = unicode(f.readline(), self.encoding).strip().split(self.delimiter)
+            rows.append( (self.convertfields(fields, False, False), int(linenums[i])) )
+        f.close()
+        return rows
 
 
 
@@ -823,6 +1979,11 @@ class Campyon(object):
     def plot(self, show=True):
         barcolors = 'rgbymc'
 
+        if self.plotfile:
+            loadplotting('Agg') #non-interactive
+        else:
+            loadplotting()
+
         #fig = matplotlib.pyplot.figure()
         matplotlib.pyplot.clf()
         if self.plotgrid:
@@ -833,7 +1994,7 @@ class Campyon(object):
         if self.plottitle:
             matplotlib.pyplot.title(self.plottitle)
 
-        if all([ isinstance(x,float) or isinstance(x,int) for x in self.xs ]):
+        if isinstance(self.xs, array.array) or all([ isinstance(x,float) or isinstance(x,int) for x in self.xs ]):
             if self.plotylog:
                 matplotlib.pyplot.set_yscale('log')
 
@@ -847,8 +2008,18 @@ class Campyon(object):
 
             l = []
             for i, field in enumerate(self.y):
-                l.append(self.xs)
-                l.append(self.ys[field])
+                xs = self.xs
+                ys = self.ys[field]
+                if self.plotpoints and len(xs) > self.plotpoints:
+                    if '-' in self.plotconf[i]:
+                        xs, ys = lttb(xs, ys, self.plotpoints)
+                    else:
+                        xs, ys = thin(xs, ys, self.plotpoints)
+                    print >>sys.stderr, "Downsampled column #" + str(field) + " from " + str(len(self.xs)) + " to " + str(len(xs)) + " points"
+                if isinstance(xs, array.array): xs = numpy.frombuffer(xs, dtype=numpy.float64)
+                if isinstance(ys, array.array): ys = numpy.frombuffer(ys, dtype=numpy.float64)
+                l.append(xs)
+                l.append(ys)
                 l.append(self.plotconf[i])
 
 
@@ -882,7 +2053,8 @@ class Campyon(object):
     def headerfields(self):
         return [x[1] for x in sorted(self.header.items()) ]
 
-    def printstats(self, out=sys.stderr):
+    def printstats(self, out=None):
+        if out is None: out = sys.stderr
         out.write("COLUMN\tSUM\tAVERAGE\n")
         for colnum, colname, s, average in self.stats():
             if colname == str(colnum):
@@ -900,9 +2072,22 @@ class Campyon(object):
             yield i, colname, self.sumdata[i], self.sumdata[i] / float(self.rowcount_out)
 
 
-    def printhist(self, columnindex, out=sys.stderr):
+    def printhist(self, columnindex, out=None):
+        if out is None: out = sys.stderr
         for i, (word, count, f) in enumerate(self.histdata(columnindex)):
-            print >>sys.stderr, str(i+1) + ")\t" + word.encode(self.encoding) + "\t" + str(count) + "\t" + str(f * 100) + '%'
+            print >>out, str(i+1) + ")\t" + word.encode(self.encoding) + "\t" + str(count) + "\t" + str(f * 100) + '%'
+
+    def printcooc(self, out=None):
+        if out is None: out = sys.stderr
+        table = self.cooctable
+        hx, hy, hxy = table.entropies()
+        print >>out, "Co-occurrence of column #" + str(self.cooc[0]) + " and column #" + str(self.cooc[1]) + "\tpairs=" + str(len(table.joint)) + "\ttokens=" + str(table.tokens) + "\tH(X)=" + str(hx) + "\tH(Y)=" + str(hy) + "\tH(X,Y)=" + str(hxy) + "\tH(Y|X)=" + str(hxy - hx) + "\tMI=" + str(hx + hy - hxy)
+        if table.pruned:
+            print >>out, "(pruned to the top " + str(table.top) + " pairs, " + str(table.pruned) + " tokens fell in pruned pairs, H(X,Y), H(Y|X) and MI are approximations)"
+        print >>out,"------------------------------------------------------------------------"
+        print >>out, "#\tX\tY\tCOUNT\tP(X,Y)\tCOUNT(X)\tCOUNT(Y)\tP(Y|X)"
+        for i, (x, y, count, p, countx, county) in enumerate(table.data()):
+            print >>out, str(i+1) + ")\t" + x.encode(self.encoding) + "\t" + y.encode(self.encoding) + "\t" + str(count) + "\t" + str(p * 100) + '%\t' + str(countx) + "\t" + str(county) + "\t" + str(count / float(countx) * 100) + '%'
 
     def entropy(self, columnindex):
         return calcentropy(self.freq[columnindex])
@@ -928,6 +2113,752 @@ class Campyon(object):
         raise KeyError("Column " + colname + " not found")
 
 
+def numericvalue(field):
+    """Convert a field like -S does, None if not numeric"""
+    try:
+        if '.' in field:
+            return float(field)
+        else:
+            return int(field)
+    except ValueError:
+        return None
+
+ISOTIMESTAMP = re.compile(r'^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(\.\d+)?)?)?(Z|[+-]\d\d:?\d\d)?$')
+
+def timestampvalue(field):
+    """Seconds since the epoch for an ISO 8601 timestamp (UTC by default), None otherwise"""
+    import calendar
+    match = ISOTIMESTAMP.match(field.strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    seconds = calendar.timegm( (int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0)) )
+    if fraction:
+        seconds += float(fraction)
+    if zone and zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        if zone[0] == '+':
+            seconds -= offset
+        else:
+            seconds += offset
+    return seconds
+
+class RollingWindow(object):
+    """Aggregate over the last size values of a column"""
+
+    FUNCTIONS = ('avg','sum','count','min','max')
+
+    def __init__(self, function, size):
+        if not function in self.FUNCTIONS:
+            raise CampyonError("Unknown window function: " + function + ", choose from " + ", ".join(self.FUNCTIONS))
+        if size < 1:
+            raise CampyonError("Window size must be positive")
+        self.function = function
+        self.size = size
+        self.values = collections.deque()
+        self.extremes = collections.deque() #(seq, value), monotonic
+        self.sum = 0 #exact sum of the integer values
+        self.partials = [] #exact sum of the float values, as non-overlapping partials (see addfloat())
+        self.count = 0
+        self.seq = 0
+
+    def update(self, x):
+        self.seq += 1
+        self.values.append(x)
+        if x is not None:
+            self.add(x)
+            self.count += 1
+            if self.function == 'min':
+                while self.extremes and self.extremes[-1][1] >= x:
+                    self.extremes.pop()
+                self.extremes.append( (self.seq, x) )
+            elif self.function == 'max':
+                while self.extremes and self.extremes[-1][1] <= x:
+                    self.extremes.pop()
+                self.extremes.append( (self.seq, x) )
+        if len(self.values) > self.size:
+            old = self.values.popleft()
+            if old is not None:
+                self.add(-old)
+                self.count -= 1
+        while self.extremes and self.extremes[0][0] <= self.seq - self.size:
+            self.extremes.popleft()
+        return self.value()
+
+    def value(self):
+        if self.function == 'count':
+            return self.count
+        elif not self.count:
+            return None
+        elif self.function == 'avg':
+            return self.total() / float(self.count)
+        elif self.function == 'sum':
+            return self.total()
+        else:
+            return self.extremes[0][1]
+
+    def add(self, x):
+        if isinstance(x, float):
+            self.addfloat(x)
+        else:
+            self.sum += x
+
+    def addfloat(self, x):
+        """Exact float summation (Shewchuk), so removals leave no rounding error"""
+        partials = self.partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+
+    def total(self):
+        if not self.partials:
+            return self.sum
+        return math.fsum(self.partials + [self.sum])
+
+class TumblingWindow(object):
+    """Aggregate over a tumbling window"""
+
+    def __init__(self, function):
+        if not function in RollingWindow.FUNCTIONS:
+            raise CampyonError("Unknown window function: " + function + ", choose from " + ", ".join(RollingWindow.FUNCTIONS))
+        self.function = function
+        self.reset()
+
+    def reset(self):
+        self.sum = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def update(self, x):
+        if x is not None:
+            self.sum += x
+            self.count += 1
+            if self.min is None or x < self.min: self.min = x
+            if self.max is None or x > self.max: self.max = x
+
+    def value(self):
+        if self.function == 'count':
+            return self.count
+        elif not self.count:
+            return None
+        elif self.function == 'avg':
+            return self.sum / float(self.count)
+        elif self.function == 'sum':
+            return self.sum
+        elif self.function == 'min':
+            return self.min
+        else:
+            return self.max
+
+class CoocTable(object):
+    """Sparse joint frequency table of two columns, optionally pruned to the top pairs"""
+
+    def __init__(self, top=0):
+        self.top = top
+        self.joint = {} #(x, y) => count
+        self.x = {} #x => count
+        self.y = {} #y => count
+        self.values = {} #interned values
+        self.tokens = 0
+        self.pruned = 0
+
+    def update(self, x, y):
+        values = self.values
+        x = values.setdefault(x, x)
+        y = values.setdefault(y, y)
+        pair = (x, y)
+        self.joint[pair] = self.joint.get(pair, 0) + 1
+        self.x[x] = self.x.get(x, 0) + 1
+        self.y[y] = self.y.get(y, 0) + 1
+        self.tokens += 1
+        if self.top and len(self.joint) > 2 * self.top:
+            self.prune()
+
+    def prune(self):
+        import heapq
+        keep = heapq.nlargest(self.top, self.joint.iteritems(), key=lambda x: x[1])
+        self.pruned = self.tokens - sum([ count for _, count in keep ])
+        self.joint = dict(keep)
+
+    def entropies(self):
+        """Returns H(X), H(Y) and H(X,Y); pruned pairs count as distinct"""
+        n = float(self.tokens)
+        hx = calcentropy(dict([ (x, count / n) for x, count in self.x.iteritems() ]))
+        hy = calcentropy(dict([ (y, count / n) for y, count in self.y.iteritems() ]))
+        hxy = calcentropy(dict([ (pair, count / n) for pair, count in self.joint.iteritems() ]))
+        if self.pruned:
+            hxy += self.pruned / n * math.log(n, 2)
+        return hx, hy, hxy
+
+    def conditionalentropy(self):
+        hx, hy, hxy = self.entropies()
+        return hxy - hx
+
+    def mutualinformation(self):
+        hx, hy, hxy = self.entropies()
+        return hx + hy - hxy
+
+    def data(self):
+        """Yields (x, y, count, p(x,y), count(x), count(y)), most frequent first"""
+        n = float(self.tokens)
+        for (x, y), count in sorted(self.joint.items(), key=lambda x: x[1] * -1):
+            yield x, y, count, count / n, self.x[x], self.y[y]
+
+    def state(self):
+        return {'joint': [ [x, y, count] for (x, y), count in self.joint.iteritems() ], 'x': self.x, 'y': self.y, 'pruned': self.pruned}
+
+    def restore(self, state):
+        self.joint = {}
+        self.x = {}
+        self.y = {}
+        self.values = {}
+        for x, count in state['x'].iteritems():
+            x = self.values.setdefault(x, x)
+            self.x[x] = count
+        for y, count in state['y'].iteritems():
+            y = self.values.setdefault(y, y)
+            self.y[y] = count
+        for x, y, count in state['joint']:
+            self.joint[(self.values.setdefault(x, x), self.values.setdefault(y, y))] = count
+        self.tokens = sum(self.x.itervalues())
+        self.pruned = state['pruned']
+
+class PipelineReader(object):
+    """Pipelined reader: reads and decodes blocks of lines in a separate thread, iterable like a file (--pipeline)"""
+
+    def __init__(self, filename, encoding, blocksize, queuesize):
+        import Queue
+        self.f = open(filename,'rb')
+        self.encoding = encoding
+        self.blocksize = blocksize
+        self.queue = Queue.Queue(queuesize)
+        self.position = 0 #byte offset of the blocks handed out so far, see tell()
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def tell(self):
+        return self.position
+
+    def read(self):
+        try:
+            if u"\n".encode(self.encoding) == "\n":
+                while True:
+                    block = self.f.readlines(self.blocksize)
+                    if not block:
+                        break
+                    self.queue.put((self.f.tell(), [ unicode(line, self.encoding) for line in block ]))
+            else:
+                #encodings that are not ASCII compatible (e.g. utf-16) can not be split into lines before decoding
+                block = []
+                size = 0
+                for line in codecs.getreader(self.encoding)(self.f):
+                    block.append(line)
+                    size += len(line)
+                    if size >= self.blocksize:
+                        self.queue.put((self.f.tell(), block))
+                        block = []
+                        size = 0
+                if block:
+                    self.queue.put((self.f.tell(), block))
+            self.queue.put(None)
+        except Exception, e:
+            self.queue.put(e)
+
+    def __iter__(self):
+        import threading
+        thread = threading.Thread(target=self.read, name="campyon-reader")
+        thread.daemon = True
+        thread.start()
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            elif isinstance(block, Exception):
+                raise block
+            self.position, lines = block
+            for line in lines:
+                yield line
+        thread.join()
+        self.f.close()
+
+class UniqueFilter(object):
+    """Exact duplicate detection for --unique, spills hashes to disk beyond the memory budget"""
+
+    ENTRYSIZE = 100 #estimated bytes per hash in a set
+    PARTITIONS = 64
+
+    def __init__(self, memory=512*1024*1024):
+        import hashlib
+        self.md5 = hashlib.md5
+        self.maxentries = max(memory // self.ENTRYSIZE, 1)
+        self.seen = set()
+        self.tmpdir = None
+        self.partitions = None
+        self.count = 0 #number of deferred rows
+
+    def hash(self, key):
+        return self.md5(u"\x00".join(key).encode('utf-8')).digest()
+
+    def check(self, key, line):
+        """True if new, False if a duplicate, None if deferred to flush()"""
+        h = self.hash(key)
+        if self.partitions is None:
+            if h in self.seen:
+                return False
+            self.seen.add(h)
+            if len(self.seen) > self.maxentries:
+                self.spill()
+            return True
+        else:
+            self.count += 1
+            self.partitions[ord(h[0]) % self.PARTITIONS].write(str(self.count) + "\t" + h.encode('hex') + "\t" + line.encode('utf-8') + "\n")
+            return None
+
+    def spill(self):
+        import tempfile
+        print >>sys.stderr, "Unique filter exceeded its memory budget, spilling to disk"
+        self.tmpdir = tempfile.mkdtemp(prefix='campyon-unique-')
+        self.partitions = [ open(os.path.join(self.tmpdir, str(i)),'wb') for i in range(self.PARTITIONS) ]
+        for h in self.seen:
+            self.partitions[ord(h[0]) % self.PARTITIONS].write("S\t" + h.encode('hex') + "\n")
+        self.seen = set()
+
+    def flush(self):
+        import heapq
+        if self.partitions is None:
+            return
+        runs = []
+        for i, f in enumerate(self.partitions):
+            f.close()
+            filename = os.path.join(self.tmpdir, str(i))
+            seen = set()
+            run = open(filename + '.run','wb')
+            f = open(filename,'rb')
+            for record in f:
+                record = record.rstrip("\n").split("\t", 2)
+                if record[0] == 'S':
+                    seen.add(record[1])
+                elif not record[1] in seen:
+                    seen.add(record[1])
+                    run.write(record[0] + "\t" + record[2] + "\n")
+            f.close()
+            run.close()
+            #start the partition anew with just the hashes, so we can continue with more input afterwards
+            f = open(filename,'wb')
+            for h in seen:
+                f.write("S\t" + h + "\n")
+            self.partitions[i] = f
+            del seen
+            runs.append(self.readrun(filename + '.run'))
+
+        for _, line in heapq.merge(*runs):
+            yield line
+        for i in range(self.PARTITIONS):
+            os.unlink(os.path.join(self.tmpdir, str(i)) + '.run')
+
+    def readrun(self, filename):
+        f = open(filename,'rb')
+        for record in f:
+            count, line = record.rstrip("\n").split("\t", 1)
+            yield int(count), unicode(line, 'utf-8')
+        f.close()
+
+    def close(self):
+        import shutil
+        if self.tmpdir:
+            for f in self.partitions:
+                f.close()
+            shutil.rmtree(self.tmpdir, True)
+            self.tmpdir = None
+            self.partitions = None
+
+    def __del__(self):
+        self.close()
+
+class BloomFilter(object):
+    """Approximate duplicate detection for --unique (--uniquebloom)"""
+
+    def __init__(self, capacity, errorrate):
+        import hashlib
+        import struct
+        self.md5 = hashlib.md5
+        self.unpack = struct.unpack
+        self.size = max(int(-capacity * math.log(errorrate) / (math.log(2) ** 2)), 8)
+        self.hashcount = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        print >>sys.stderr, "Bloom filter of " + str(len(self.bits)) + " bytes with " + str(self.hashcount) + " hash functions"
+
+    def check(self, key, line):
+        h1, h2 = self.unpack('<QQ', self.md5(u"\x00".join(key).encode('utf-8')).digest())
+        new = False
+        for i in xrange(self.hashcount):
+            bit = (h1 + i * h2) % self.size
+            byte = bit >> 3
+            mask = 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                new = True
+                self.bits[byte] |= mask
+        return new
+
+    def flush(self):
+        return []
+
+    def close(self):
+        pass
+
+class ServerCache(object):
+    """Memory capped LRU cache of the query server"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict() #key => (size, value), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            size, value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = (size, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[0]
+        if size > self.capacity:
+            return
+        self.entries[key] = (size, value)
+        self.size += size
+        while self.size > self.capacity:
+            _, (oldsize, _) = self.entries.popitem(last=False)
+            self.size -= oldsize
+
+    def lines(self, filename, encoding):
+        """Decoded lines of a file, reloaded when it changes"""
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        version = (stat.st_mtime, stat.st_size)
+        key = ('file', filename, encoding)
+        entry = self.get(key)
+        if entry is None or entry[0] != version:
+            f = codecs.open(filename,'r',encoding)
+            lines = f.readlines()
+            f.close()
+            entry = (version, lines)
+            self.put(key, entry, sys.getsizeof(lines) + sum([ sys.getsizeof(line) for line in lines ]))
+        return entry[1]
+
+class ServerOutput(object):
+    """Framed stdout/stderr output of a query, recorded for the result cache"""
+
+    BUFFERSIZE = 65536
+
+    def __init__(self, conn, recordlimit):
+        self.conn = conn
+        self.channel = None
+        self.chunks = []
+        self.buffered = 0
+        self.pending = []
+        self.frames = [] #(channel, data) for the result cache, None once the limit is exceeded
+        self.recorded = 0
+        self.recordlimit = recordlimit
+
+    def write(self, channel, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if channel != self.channel:
+            self.endframe()
+            self.channel = channel
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.BUFFERSIZE:
+            self.flush()
+
+    def endframe(self):
+        import struct
+        if not self.chunks:
+            return
+        data = "".join(self.chunks)
+        self.chunks = []
+        self.buffered = 0
+        self.pending.append(self.channel + struct.pack('>I', len(data)) + data)
+        if self.frames is not None:
+            self.recorded += len(data)
+            if self.recorded > self.recordlimit:
+                self.frames = None
+            else:
+                self.frames.append( (self.channel, data) )
+
+    def flush(self):
+        self.endframe()
+        if self.pending:
+            self.conn.sendall("".join(self.pending))
+            self.pending = []
+
+    def close(self, status):
+        import struct
+        self.flush()
+        self.conn.sendall('x' + struct.pack('>I', 4) + struct.pack('>i', status))
+
+class ServerChannel(object):
+    """Stands in for sys.stdout/sys.stderr during a query"""
+
+    softspace = 0
+
+    def __init__(self, output, channel):
+        self.output = output
+        self.channel = channel
+
+    def write(self, data):
+        self.output.write(self.channel, data)
+
+    def flush(self):
+        self.output.flush()
+
+    def isatty(self):
+        return False
+
+class CampyonServer(object):
+    """Query server (--serve), answers queries from --client over a Unix socket"""
+
+    UNSUPPORTED = ('-V','--follow','--pipeline','--serve','--client')
+    NOCACHE = ('-o','-i','--copysuffix','--plotfile','--profile','--profilejson','--progress','--checkpoint')
+
+    def __init__(self, socketpath, memory=1024):
+        self.socketpath = socketpath
+        self.cache = ServerCache(int(memory * 1024 * 1024))
+        self.cwd = os.getcwd()
+
+    def serve(self):
+        """Serve until interrupted, returns the exit status"""
+        import signal
+        import socket
+        import traceback
+        if os.path.exists(self.socketpath):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socketpath)
+            except socket.error:
+                os.unlink(self.socketpath) #stale socket of a server that is no longer running
+            else:
+                print >>sys.stderr, "ERROR: A server is already running on " + self.socketpath
+                return 2
+            finally:
+                probe.close()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socketpath)
+        os.chmod(self.socketpath, 0600)
+        sock.listen(16)
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        print >>sys.stderr, "Serving on " + self.socketpath
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    self.handle(conn)
+                except socket.error, e:
+                    print >>sys.stderr, "Connection error: " + str(e)
+                except Exception:
+                    print >>sys.stderr, "Error handling request:"
+                    traceback.print_exc()
+                finally:
+                    conn.close()
+        except KeyboardInterrupt:
+            print >>sys.stderr, "Interrupted, stopping server"
+        finally:
+            sock.close()
+            os.unlink(self.socketpath)
+        return 0
+
+    def handle(self, conn):
+        import json
+        f = conn.makefile('rb')
+        line = f.readline()
+        f.close()
+        output = ServerOutput(conn, self.cache.capacity / 4)
+        try:
+            request = json.loads(line)
+            args = [ arg.encode('utf-8') for arg in request['args'] ]
+            cwd = request['cwd']
+            if not isinstance(cwd, basestring):
+                raise TypeError("cwd must be a string")
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            import socket
+            print >>sys.stderr, "Invalid request: " + str(e)
+            try:
+                output.write('e', "ERROR: Invalid request: " + str(e) + "\n")
+                output.close(2)
+            except socket.error:
+                pass #the peer is gone already, e.g. the probe of a starting server
+            return
+        begintime = time.time()
+        status, cached = self.query(args, cwd, output)
+        output.close(status)
+        print >>sys.stderr, "Query " + " ".join(args) + " in " + cwd + ": status " + str(status) + ", " + ("cached" if cached else "%.3fs" % (time.time() - begintime)) + ", cache " + str(self.cache.size / (1024*1024)) + " MB in " + str(len(self.cache.entries)) + " entries, " + str(self.cache.hits) + " hits, " + str(self.cache.misses) + " misses"
+
+    def query(self, args, cwd, output):
+        """Run a query in the client's working directory, returns (status, cached)"""
+        import socket
+        import traceback
+        try:
+            opts, filenames = getopt.getopt(args, SHORTOPTIONS, LONGOPTIONS)
+        except getopt.GetoptError, err:
+            output.write('e', str(err) + "\n")
+            return 2, False
+        options = set([ o for o, _ in opts ])
+        for o in self.UNSUPPORTED:
+            if o in options:
+                output.write('e', "ERROR: " + o + " is not supported by the query server\n")
+                return 2, False
+        if ('-x' in options or '-y' in options) and not '--plotfile' in options:
+            output.write('e', "ERROR: the query server can only plot to a file, use --plotfile\n")
+            return 2, False
+        if not filenames:
+            filenames = [ a for o, a in opts if o == '-f' ][-1:]
+
+        key = None
+        if not options & set(self.NOCACHE):
+            try:
+                versions = []
+                for filename in filenames:
+                    stat = os.stat(os.path.join(cwd, filename))
+                    versions.append( (os.path.abspath(os.path.join(cwd, filename)), stat.st_mtime, stat.st_size) )
+                key = ('result', cwd, tuple(args), tuple(versions))
+            except OSError:
+                pass #campyon will report the missing file
+        if key:
+            result = self.cache.get(key)
+            if result:
+                frames, status = result
+                for channel, data in frames:
+                    output.write(channel, data)
+                return status, True
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = ServerChannel(output, 'o')
+        sys.stderr = ServerChannel(output, 'e')
+        try:
+            os.chdir(cwd)
+            campyon = Campyon(*args, filecache=self.cache)
+            campyon()
+            status = 0
+        except SystemExit, e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                print >>sys.stderr, e.code
+                status = 1
+        except socket.error:
+            raise
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(self.cwd)
+        output.endframe()
+
+        if key and status == 0 and output.frames is not None:
+            self.cache.put(key, (output.frames, status), output.recorded)
+        return status, False
+
+def client(socketpath, args):
+    """Send a query to the server and relay its output, returns the exit status"""
+    import json
+    import socket
+    import struct
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socketpath)
+    except socket.error, e:
+        print >>sys.stderr, "Unable to connect to the query server on " + socketpath + ": " + str(e)
+        return 2
+    sock.sendall(json.dumps({'args': args, 'cwd': os.getcwd()}) + "\n")
+    f = sock.makefile('rb')
+    try:
+        while True:
+            head = f.read(5)
+            if len(head) < 5:
+                print >>sys.stderr, "Connection to the query server was lost"
+                return 1
+            channel = head[0]
+            data = f.read(struct.unpack('>I', head[1:])[0])
+            if channel == 'o':
+                sys.stdout.write(data)
+            elif channel == 'e':
+                sys.stderr.write(data)
+            elif channel == 'x':
+                return struct.unpack('>i', data)[0]
+    finally:
+        f.close()
+        sock.close()
+
+def servermain(args):
+    import tempfile
+    socketpath = os.path.join(tempfile.gettempdir(), 'campyon-' + str(os.getuid()) + '.sock')
+    memory = 1024
+    serve = False
+    queryargs = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--serve':
+            serve = True
+        elif arg == '--client':
+            pass
+        elif arg in ('--socket','--servememory') and i + 1 < len(args):
+            i += 1
+            if arg == '--socket':
+                socketpath = args[i]
+            else:
+                memory = float(args[i])
+        elif arg.startswith('--socket='):
+            socketpath = arg[len('--socket='):]
+        elif arg.startswith('--servememory='):
+            memory = float(arg[len('--servememory='):])
+        else:
+            queryargs.append(arg)
+        i += 1
+    if serve:
+        return CampyonServer(socketpath, memory).serve()
+    else:
+        return client(socketpath, queryargs)
+
+class ReverseSortKey(object):
+    """Sort key with reversed order, for heapq.merge"""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __gt__(self, other):
+        return other.key > self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
 class ConjunctionSelector(object):
     def __init__(self, c, *args):
         self.args = [ c(x) for x in args ]
@@ -981,5 +2912,7 @@ class DisjunctionSelector(object):
 
 
 if __name__ == "__main__":
+    if '--serve' in sys.argv[1:] or '--client' in sys.argv[1:]:
+        sys.exit(servermain(sys.argv[1:]))
     campyon = Campyon(*sys.argv[1:])
     campyon()
@@ -0,0 +1,364 @@
+#! /usr/bin/env python
+# -*- coding: utf8 -*-
+
+
+
+###############################################################
+# CAMPYON BENCHMARK
+#       by Maarten van Gompel (proycon)
+#       http://github.com/proycon/campyon
+#
+#       Centre for Language Studies
+#       Radboud University Nijmegen
+#
+#       Licensed under GPLv3
+#
+# Reproducible performance benchmarks for Campyon. Generates deterministic
+# synthetic data files, times the main Campyon code paths on them and stores
+# the results as JSON so runs can be compared.
+#
+###############################################################
+
+
+import sys
+import os
+import getopt
+import json
+import time
+import random
+import platform
+import tempfile
+import subprocess
+
+CAMPYON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'campyon.py')
+
+WORDS = ['alpha','bravo','charlie','delta','echo','foxtrot','golf','hotel','india','juliet','kilo','lima','mike','november','oscar','papa','quebec','romeo','sierra','tango','uniform','victor','whiskey','xray','yankee','zulu']
+
+SHAPES = {'narrow': 4, 'wide': 40}
+KINDS = ('numeric','text')
+FORMATS = {'tsv': "\t", 'csv': ","}
+
+#name => campyon arguments, column 1 is always an integer ID and column 2 always a categorical word
+CASES = [
+    ('passthrough', []),
+    ('select', ['-s', 'r("7$",1)']),
+    ('grep', ['-g', 'kilo']),
+    ('keep', ['-k', '1,3']),
+    ('delete', ['-d', '2']),
+    ('stats', ['-S']),
+    ('hist', ['-H', '2']),
+    ('sort', ['-A', '2']),
+    ('reverseaxes', ['-R']),
+    ('prettyview', ['-v']),
+    ('pipeline', ['--pipeline']),
+    ('pipeline-stats', ['--pipeline', '-S']),
+    ('numpy-stats', ['--numpy', '-S']),
+    ('numpy-hist', ['--numpy', '-H', '2']),
+]
+
+#cases that must report exactly the same statistics (on stderr) as a run with the reference arguments, checked before timing
+EQUIVALENT = {
+    'numpy-stats': ['-S'],
+    'numpy-hist': ['-H', '2'],
+}
+
+#optional modules a case depends on, the case is skipped if the module is not available
+REQUIRES = {
+    'numpy-stats': 'numpy',
+    'numpy-hist': 'numpy',
+}
+
+#modules that should never be loaded for plain text runs or plain library imports
+HEAVYMODULES = ['numpy','matplotlib','gtk']
+
+STARTUPSCRIPT = """
+import sys, time
+begintime = time.time()
+sys.path.insert(0, %r)
+import campyon
+duration = time.time() - begintime
+print repr(duration)
+print ",".join([ m for m in %r if m in sys.modules ])
+"""
+
+
+def usage():
+    print >>sys.stderr,"Campyon Benchmark - by Maarten van Gompel - http://github.com/proycon/campyon"
+    print >>sys.stderr,"Usage: campyonbench [options]"
+    print >>sys.stderr,"       campyonbench --compare [baseline.json] [current.json]"
+    print >>sys.stderr,"Options:"
+    print >>sys.stderr," -r [rows]        Number of rows in each generated data file (default: 20000)"
+    print >>sys.stderr," -n [repeats]     Number of timed runs per benchmark, the best is reported (default: 3)"
+    print >>sys.stderr," -o [jsonfile]    Write results to the specified JSON file"
+    print >>sys.stderr," -c [cases]       Comma separated list of benchmark cases to run (default: all)"
+    print >>sys.stderr,"                  Available: startup," + ",".join([ name for name, _ in CASES ])
+    print >>sys.stderr," -t [datasets]    Comma separated list of datasets to run, e.g. narrow-numeric-tsv (default: all)"
+    print >>sys.stderr," --seed=[seed]    Random seed for the data generator (default: 1)"
+    print >>sys.stderr," --datadir=[dir]  Directory to generate data files in (default: system temp directory)"
+    print >>sys.stderr," --compare        Compare two result files and flag regressions"
+    print >>sys.stderr," --threshold=[f]  Relative slowdown (or memory growth) considered a regression, (default: 0.1)"
+
+
+def datasets():
+    for shape in sorted(SHAPES):
+        for kind in KINDS:
+            for fmt in sorted(FORMATS):
+                yield shape + '-' + kind + '-' + fmt
+
+
+def generate(dataset, rows, seed, datadir):
+    """Generate a deterministic data file for the given dataset (shape-kind-format), returns the filename. Files that already exist are reused"""
+    shape, kind, fmt = dataset.split('-')
+    filename = os.path.join(datadir, 'campyonbench-' + dataset + '-' + str(rows) + '-' + str(seed) + '.' + fmt)
+    if os.path.exists(filename):
+        return filename
+
+    rng = random.Random(seed)
+    delimiter = FORMATS[fmt]
+    fieldcount = SHAPES[shape]
+    f = open(filename + '.tmp','w')
+    f.write(delimiter.join(['id','word'] + [ 'col' + str(i) for i in range(3, fieldcount+1) ]) + "\n")
+    for i in range(1, rows+1):
+        fields = [str(i), rng.choice(WORDS)]
+        for j in range(3, fieldcount+1):
+            if kind == 'numeric':
+                if j % 2:
+                    fields.append(str(rng.randint(-1000,100000)))
+                else:
+                    fields.append("%.4f" % rng.uniform(-1000,1000))
+            else:
+                fields.append("_".join([ rng.choice(WORDS) for _ in range(rng.randint(1,4)) ]))
+        f.write(delimiter.join(fields) + "\n")
+    f.close()
+    os.rename(filename + '.tmp', filename)
+    return filename
+
+
+def command(filename, delimiter, args):
+    if delimiter == "\t":
+        cmd = [sys.executable, CAMPYON, '-T']
+    else:
+        cmd = [sys.executable, CAMPYON, '-D', delimiter]
+    return cmd + ['-1'] + args + [filename]
+
+
+def available(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def verify(filename, delimiter, args, reference):
+    """Check that campyon reports the same on stderr with args as with the reference arguments"""
+    reports = []
+    for a in (args, reference):
+        devnull = open(os.devnull,'w')
+        p = subprocess.Popen(command(filename, delimiter, a), stdout=devnull, stderr=subprocess.PIPE)
+        reports.append(p.communicate()[1])
+        devnull.close()
+        if p.returncode != 0:
+            raise Exception("Benchmark command failed: " + " ".join(command(filename, delimiter, a)))
+    if reports[0] != reports[1]:
+        raise Exception("Output of " + " ".join(args) + " differs from " + " ".join(reference) + " on " + filename)
+
+
+def run(filename, delimiter, args):
+    """Run campyon once, returns the wall-clock time and the peak resident set size (in kB) of the child process"""
+    cmd = command(filename, delimiter, args)
+    devnull = open(os.devnull,'w')
+    begintime = time.time()
+    p = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    _, status, rusage = os.wait4(p.pid, 0)
+    duration = time.time() - begintime
+    p.returncode = status
+    devnull.close()
+    if status != 0:
+        raise Exception("Benchmark command failed: " + " ".join(cmd))
+    return duration, rusage.ru_maxrss
+
+
+def startup(repeats, datadir):
+    """Time the startup of campyon, both as a library import and as a plain text command line run on a tiny file. Fails if heavy optional dependencies get loaded"""
+    filename = os.path.join(datadir, 'campyonbench-startup.tsv')
+    f = open(filename,'w')
+    f.write("1\talpha\n2\tbravo\n")
+    f.close()
+
+    results = []
+    best = None
+    for _ in range(repeats):
+        p = subprocess.Popen([sys.executable, '-c', STARTUPSCRIPT % (os.path.dirname(CAMPYON), HEAVYMODULES)], stdout=subprocess.PIPE)
+        output = p.communicate()[0].strip().split("\n")
+        if p.returncode != 0:
+            raise Exception("Startup benchmark failed")
+        duration = float(output[0])
+        if len(output) > 1 and output[1]:
+            raise Exception("Importing campyon loaded heavy modules: " + output[1])
+        if best is None or duration < best:
+            best = duration
+    results.append({'dataset': '-', 'case': 'startup-import', 'args': [], 'seconds': best, 'rowspersec': None, 'maxrss_kb': 0 })
+
+    best = None
+    maxrss = 0
+    for _ in range(repeats):
+        duration, rss = run(filename, "\t", [])
+        if best is None or duration < best:
+            best = duration
+        maxrss = max(maxrss, rss)
+    results.append({'dataset': '-', 'case': 'startup-run', 'args': [], 'seconds': best, 'rowspersec': None, 'maxrss_kb': maxrss })
+
+    for result in results:
+        print >>sys.stderr, "%-22s %-12s %10.3fs %8d kB" % (result['dataset'], result['case'], result['seconds'], result['maxrss_kb'])
+    return results
+
+
+def benchmark(rows=20000, repeats=3, seed=1, datadir=None, selectcases=None, selectdatasets=None):
+    if not datadir:
+        datadir = tempfile.gettempdir()
+    results = []
+    if not selectcases or 'startup' in selectcases:
+        results += startup(repeats, datadir)
+    for dataset in datasets():
+        if selectdatasets and not dataset in selectdatasets:
+            continue
+        filename = generate(dataset, rows, seed, datadir)
+        size = os.path.getsize(filename)
+        delimiter = FORMATS[dataset.split('-')[2]]
+        for name, args in CASES:
+            if selectcases and not name in selectcases:
+                continue
+            if name in REQUIRES and not available(REQUIRES[name]):
+                print >>sys.stderr, "%-22s %-12s skipped, %s is not available" % (dataset, name, REQUIRES[name])
+                continue
+            if name in EQUIVALENT:
+                verify(filename, delimiter, args, EQUIVALENT[name])
+            best = None
+            maxrss = 0
+            for _ in range(repeats):
+                duration, rss = run(filename, delimiter, args)
+                if best is None or duration < best:
+                    best = duration
+                maxrss = max(maxrss, rss)
+            result = {
+                'dataset': dataset,
+                'case': name,
+                'args': args,
+                'rows': rows,
+                'bytes': size,
+                'seconds': best,
+                'rowspersec': rows / best,
+                'mbpersec': size / best / (1024.0*1024.0),
+                'maxrss_kb': maxrss,
+            }
+            print >>sys.stderr, "%-22s %-12s %10.3fs %12.0f rows/s %8.2f MB/s %8d kB" % (dataset, name, best, result['rowspersec'], result['mbpersec'], maxrss)
+            results.append(result)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rows': rows,
+            'repeats': repeats,
+            'seed': seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare two benchmark result sets, prints a report and returns the number of regressions"""
+    index = dict([ ((r['dataset'], r['case']), r) for r in baseline['results'] ])
+    regressions = 0
+    print "DATASET\tCASE\tROWS/S(OLD)\tROWS/S(NEW)\tCHANGE\tRSS(OLD)\tRSS(NEW)\tCHANGE\tSTATUS"
+    for r in current['results']:
+        key = (r['dataset'], r['case'])
+        if not key in index:
+            continue
+        old = index[key]
+        if r['rowspersec'] is None or old['rowspersec'] is None:
+            #startup benchmarks, compare raw time
+            speedchange = old['seconds'] / r['seconds'] - 1.0
+            r = dict(r, rowspersec=1.0/r['seconds'])
+            old = dict(old, rowspersec=1.0/old['seconds'])
+        else:
+            speedchange = r['rowspersec'] / old['rowspersec'] - 1.0
+        if old['maxrss_kb']:
+            memchange = r['maxrss_kb'] / float(old['maxrss_kb']) - 1.0
+        else:
+            memchange = 0.0
+        status = "ok"
+        if speedchange < -threshold or memchange > threshold:
+            status = "REGRESSION"
+            regressions += 1
+        print "%s\t%s\t%.0f\t%.0f\t%+.1f%%\t%d\t%d\t%+.1f%%\t%s" % (r['dataset'], r['case'], old['rowspersec'], r['rowspersec'], speedchange * 100, old['maxrss_kb'], r['maxrss_kb'], memchange * 100, status)
+    return regressions
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "r:n:o:c:t:h",["seed=","datadir=","compare","threshold="])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    rows = 20000
+    repeats = 3
+    seed = 1
+    datadir = None
+    outputfile = None
+    selectcases = None
+    selectdatasets = None
+    docompare = False
+    threshold = 0.1
+
+    for o, a in opts:
+        if o == '-r':
+            rows = int(a)
+        elif o == '-n':
+            repeats = int(a)
+        elif o == '-o':
+            outputfile = a
+        elif o == '-c':
+            selectcases = a.split(',')
+        elif o == '-t':
+            selectdatasets = a.split(',')
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+        elif o == '--seed':
+            seed = int(a)
+        elif o == '--datadir':
+            datadir = a
+        elif o == '--compare':
+            docompare = True
+        elif o == '--threshold':
+            threshold = float(a)
+        else:
+            raise Exception("invalid option: " + o)
+
+    if docompare:
+        if len(args) != 2:
+            usage()
+            sys.exit(2)
+        baseline = json.load(open(args[0]))
+        current = json.load(open(args[1]))
+        regressions = compare(baseline, current, threshold)
+        if regressions:
+            print >>sys.stderr, str(regressions) + " regression(s) found"
+            sys.exit(1)
+    else:
+        data = benchmark(rows, repeats, seed, datadir, selectcases, selectdatasets)
+        if outputfile:
+            f = open(outputfile,'w')
+            json.dump(data, f, indent=1)
+            f.close()
+        else:
+            print json.dumps(data, indent=1)
+
+
+if __name__ == "__main__":
+    main()